@@ -1,8 +1,15 @@
+import os
+import hashlib
+import mmap
+import pickle
+import threading
 import pandas as pd
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 from sklearn.model_selection import StratifiedKFold
 from sklearn.model_selection import cross_val_score
+from sklearn.base import clone
 
 from xgboost import XGBClassifier
 from lightgbm import LGBMClassifier
@@ -37,47 +44,399 @@ stack = Stacker(n_splits=3,
         
 y_pred = stack.fit_predict(train, target_train, test)  # get the predictions!!
 
+The 35 (model, fold) fits of 7 models x 5 folds are independent; Stacker(..., n_jobs=8) runs them 8 at a time:
+
+stack = Stacker(n_splits=5, stacker=top_model, base_models=(lgb1, lgb2, xgb1), n_jobs=8)
+
+With cache_dir set, the S_train (out of fold) column and the fold models of every base model are kept on disk,
+keyed by the model class + params, the folds and the data. Adding a base model or swapping the stacker then
+only fits what is new:
+
+stack = Stacker(n_splits=5, stacker=top_model, base_models=(lgb1, lgb2, xgb1, lgb3), cache_dir='stack_cache')
+
+Boosters can also be given as native param dicts, as for xtune.xTrain (param['boosting_alg'] is 'xgb', the
+default, or 'lgb'). Each fold is then trained with xTrain, early stopping on that fold's holdout, and predicted
+with xPredict at the best iteration, so no fold trains or predicts with more trees than it needs:
+
+lgb_native = {'boosting_alg': 'lgb', 'objective': 'binary', 'metric': 'auc', 'num_estimators': 5000,
+              'early_stopping': 50, 'learning_rate': 0.05, 'num_leaves': 31}
+stack = Stacker(n_splits=5, stacker=top_model, base_models=(lgb1, xgb1, lgb_native))
+
+The fitted fold models and stacker are kept, so new batches are scored without any retraining:
+
+stack.fit(train, target_train)
+y_pred = stack.predict(test)
+y_pred_new = stack.predict(new_batch)
+
 '''
 
 
+def _as_array(data):
+    '''ndarray view of data: memmaps and arrays as they are, DataFrames/Series without a copy where possible.'''
+    if hasattr(data, 'to_numpy'):
+        return data.to_numpy(copy=False)
+    return np.asarray(data)
+
+
+def _picklable(arr):
+    # memmaps are reopened by the worker processes instead of being pickled (ie. copied into each of them)
+    if isinstance(arr, np.memmap) and isinstance(arr.base, mmap.mmap) and arr.filename:
+        order = 'F' if arr.flags.f_contiguous and not arr.flags.c_contiguous else 'C'
+        return ('memmap', arr.filename, arr.dtype, arr.shape, arr.offset, order)
+    return arr
+
+
+def _unpicklable(arr):
+    if isinstance(arr, tuple) and arr[0] == 'memmap':
+        _, filename, dtype, shape, offset, order = arr
+        return np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=offset, order=order)
+    return arr
+
+
+def _positive_proba(model, data):
+    '''Class 1 probabilities of a fitted sklearn style classifier or _NativeModel.'''
+    if isinstance(model, _NativeModel):
+        return model.predict(data)
+    return model.predict_proba(data)[:,1]
+
+
+class _NativeModel(object):
+    '''An xgb/lgb booster trained with xtune.xTrain, predicting at its best iteration via xtune.xPredict.'''
+    def __init__(self, model, boosting_alg, best_iteration=-1):
+        self.model = model
+        self.boosting_alg = boosting_alg
+        self.best_iteration = best_iteration
+
+    def predict(self, data):
+        import xtune
+        if self.boosting_alg == 'xgb':
+            pred = xtune.xPredict(self.model, xtune.xgb.DMatrix(data), 'xgb')
+        else:
+            pred = xtune.xPredict(self.model, data, 'lgb', lgb_best_iteration=self.best_iteration)
+        pred = np.asarray(pred)
+        return pred[:, -1] if pred.ndim == 2 else pred # multi:softprob style (rows, 2) -> class 1
+
+
+def _native_param(param):
+    '''Copy of an xTrain param dict with the keys xTrain expects filled in (as xGridSearch does for lgb).'''
+    param = dict(param)
+    param.setdefault('feval', None)
+    if param.get('boosting_alg', 'xgb') == 'xgb':
+        param.setdefault('maximize_feval', False)
+    else:
+        param.pop('maximize_feval', None) # lgb does not take this param
+        if 'eval_metric' in param:
+            param['metric'] = param.pop('eval_metric')
+    return param
+
+
+def _fit_native(param, X_train, y_train, X_holdout, y_holdout):
+    '''Trains a native xgb/lgb param dict on one fold with xtune.xTrain, early stopping on the fold's holdout.'''
+    import xtune
+    param = _native_param(param)
+    if param.get('boosting_alg', 'xgb') == 'xgb':
+        d_train = xtune.xgb.DMatrix(X_train, label=y_train)
+        d_holdout = xtune.xgb.DMatrix(X_holdout, label=y_holdout)
+        model, _ = xtune.xTrain(d_train, param, d_holdout, verbose_eval=False, boosting_alg='xgb')
+        return _NativeModel(model, 'xgb')
+    else:
+        d_train = xtune.lgb.Dataset(X_train, label=y_train, free_raw_data=False)
+        d_holdout = xtune.lgb.Dataset(X_holdout, label=y_holdout, reference=d_train, free_raw_data=False)
+        model, _ = xtune.xTrain(d_train, param, d_holdout, verbose_eval=False, boosting_alg='lgb')
+        return _NativeModel(model, 'lgb', model.best_iteration if model.best_iteration > 0 else -1) # -1: all trees
+
+
+def _clone(clf):
+    return dict(clf) if isinstance(clf, dict) else clone(clf)
+
+
+def _model_name(clf):
+    if isinstance(clf, dict):
+        return 'xTrain[%s]' % clf.get('boosting_alg', 'xgb')
+    return str(clf).split('(')[0]
+
+
+class _FoldSlices(object):
+    '''
+    X[train_idx], y[train_idx], X[test_idx] and y[test_idx] of a fold, sliced once and shared by all the base
+    models fitted on it. A fold's slices are dropped once n_users models are done with it (keep_last: only the
+    last fold used is kept instead, for a worker process which does not see all the tasks).
+    '''
+    def __init__(self, X, y, folds, n_users, keep_last=False):
+        self.X = X
+        self.y = y
+        self.folds = folds
+        self.n_users = n_users
+        self.keep_last = keep_last
+        self.slices = {}
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, j):
+        with self.lock:
+            if j not in self.slices:
+                if self.keep_last:
+                    self.slices.clear()
+                train_idx, test_idx = self.folds[j] # sorted, so memmaps are read front to back
+                self.slices[j] = (self.X[train_idx], self.y[train_idx], self.X[test_idx], self.y[test_idx])
+                self.users[j] = self.n_users
+            return self.slices[j]
+
+    def release(self, j):
+        with self.lock:
+            if self.keep_last:
+                return
+            self.users[j] -= 1
+            if self.users[j] == 0:
+                del self.slices[j], self.users[j]
+
+
+_fold_worker_state = {}
+
+def _fold_worker_init(X, y, folds):
+    # the data is sent once per worker process instead of once per (model, fold) task
+    _fold_worker_state['slices'] = _FoldSlices(_unpicklable(X), y, folds, None, keep_last=True)
+
+
+_THREAD_PARAMS = ('n_jobs', 'nthread', 'thread_count', 'num_threads')
+
+def _limit_threads(clf, n_threads):
+    '''Caps the threads of one fit via n_jobs / nthread / thread_count / num_threads, whichever the model has.'''
+    if n_threads is None:
+        return clf
+    if isinstance(clf, dict):
+        keys = [key for key in _THREAD_PARAMS if key in clf]
+        if not keys:
+            keys = ['num_threads' if clf.get('boosting_alg', 'xgb') == 'lgb' else 'nthread']
+        clf.update((key, n_threads) for key in keys)
+        return clf
+    params = clf.get_params(deep=False)
+    clf.set_params(**{key: n_threads for key in _THREAD_PARAMS if key in params})
+    return clf
+
+
+def _fingerprint(arr, chunk_rows=100000):
+    '''sha1 of an array's shape, dtype and contents, read chunk_rows rows at a time.'''
+    hasher = hashlib.sha1(repr((arr.shape, arr.dtype.str)).encode('utf-8'))
+    for start in range(0, max(len(arr), 1), chunk_rows):
+        chunk = np.ascontiguousarray(arr[start:start + chunk_rows])
+        hasher.update(memoryview(chunk.reshape(-1).view(np.uint8)) if chunk.dtype != object else repr(chunk.tolist()).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def _model_key(clf, data_key):
+    # thread counts do not change the predictions, so they are not part of the key
+    if isinstance(clf, dict):
+        kind = ('xtune.xTrain', clf.get('boosting_alg', 'xgb'))
+        params = clf
+    else:
+        kind = (type(clf).__module__, type(clf).__name__)
+        params = clf.get_params()
+    params = sorted((k, getattr(v, '__name__', None) or repr(v)) for k, v in params.items() if k not in _THREAD_PARAMS)
+    desc = repr((kind, params, data_key))
+    return hashlib.sha1(desc.encode('utf-8')).hexdigest()
+
+
+def _load_fold_models(cache_dir, key):
+    fname = os.path.join(cache_dir, key + '.pkl')
+    if not os.path.exists(fname):
+        return None
+    with open(fname, 'rb') as f:
+        cached = pickle.load(f)
+    return cached['oof'], cached['models']
+
+
+def _save_fold_models(cache_dir, key, oof, models):
+    fname = os.path.join(cache_dir, key + '.pkl')
+    tmp = fname + '.tmp%d' % os.getpid()
+    with open(tmp, 'wb') as f:
+        pickle.dump({'oof': oof, 'models': models}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, fname)
+
+
+def _fit_fold(clf, slices, j, dtype):
+    '''Fits clf on fold j, returns the fitted model and its holdout predictions.'''
+    X_train, y_train, X_holdout, y_holdout = slices.acquire(j)
+    try:
+        if isinstance(clf, dict):
+            model = _fit_native(clf, X_train, y_train, X_holdout, y_holdout)
+        else:
+            model = clf.fit(X_train, y_train)
+        return model, _positive_proba(model, X_holdout).astype(dtype)
+    finally:
+        slices.release(j)
+
+
+def _fit_fold_task(i, j, clf, n_threads, dtype, slices=None):
+    if slices is None:
+        slices = _fold_worker_state['slices']
+    model, y_pred = _fit_fold(_limit_threads(clf, n_threads), slices, j, dtype)
+    return i, j, model, y_pred
+
+
 class Stacker(object):
-    def __init__(self, n_splits, stacker, base_models):
+    '''
+    base_models: sklearn style classifiers and/or native xgb/lgb param dicts for xtune.xTrain (see above).
+    n_jobs: number of (model, fold) fits run at the same time, and of fold models predicting at the same time
+    in predict. 1 (default) runs them one after the other.
+    backend: 'process' (a process pool; X and y are sent once to each worker, memmaps are just reopened) or
+    'thread' (no copies of the data; fine for xgboost/lightgbm/catboost, which release the GIL while training).
+    threads_per_fit: thread cap set on each parallel fit through its n_jobs/nthread/thread_count param, so
+    that n_jobs boosters do not oversubscribe the cpus. 'auto' is cpu_count // n_jobs, None leaves the params alone.
+    
+    The parallel fits train clones of the base models and fill S_train as they finish, in any order; the
+    stacker output is the same as with n_jobs=1 given deterministic base models (fixed random_state/seed).
+    
+    cache_dir: folder for the per model S_train column and fold models. The key is the model class and
+    get_params() (minus thread counts), n_splits, random_state (the fold seed) and sha1 fingerprints of X and y,
+    so any change to these refits the model. Each model is saved as soon as its last fold is done.
+    random_state: seed of the StratifiedKFold split.
+    
+    Memory: X and T can be memmaps or DataFrames and are never copied as a whole. Each fold is sliced once
+    for all the base models, T is scored chunk_rows rows at a time, and the meta features S_train/S_test are
+    meta_dtype (float32).
+    
+    fit(X, y) keeps the fold models of every base model (fold_models_) and the fitted stacker, so that
+    predict(T) - on any number of later batches - only costs inference: each chunk of T goes through all
+    the fold models, whose predictions are averaged per base model, and then through the stacker.
+    fit_predict(X, y, T) is fit(X, y).predict(T).
+    '''
+    def __init__(self, n_splits, stacker, base_models, n_jobs=1, backend='process', threads_per_fit='auto',
+                 cache_dir=None, random_state=2016, chunk_rows=100000, meta_dtype=np.float32):
         self.n_splits = n_splits
         self.stacker = stacker
         self.base_models = base_models
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.threads_per_fit = threads_per_fit
+        self.cache_dir = cache_dir
+        self.random_state = random_state
+        self.chunk_rows = chunk_rows
+        self.meta_dtype = meta_dtype
 
-    def fit_predict(self, X, y, T):
-        X = np.array(X)
-        y = np.array(y)
-        T = np.array(T)
+    def _get_n_jobs(self):
+        return self.n_jobs if self.n_jobs > 0 else (os.cpu_count() or 1)
 
-        folds = list(StratifiedKFold(n_splits=self.n_splits, shuffle=True, random_state=2016).split(X, y))
+    def _model_done(self, i, S_train, fold_models, keys):
+        if self.cache_dir is not None:
+            _save_fold_models(self.cache_dir, keys[i], S_train[:, i], fold_models[i])
 
-        S_train = np.zeros((X.shape[0], len(self.base_models)))
-        S_test = np.zeros((T.shape[0], len(self.base_models)))
-        for i, clf in enumerate(self.base_models):
+    def _fit_base_models_parallel(self, X, y, folds, S_train, fold_models, todo, keys):
+        n_jobs = self._get_n_jobs()
+        n_threads = self.threads_per_fit
+        if n_threads == 'auto':
+            n_threads = max(1, (os.cpu_count() or 1) // n_jobs)
 
-            S_test_i = np.zeros((T.shape[0], self.n_splits))
+        if self.backend == 'process':
+            pool = ProcessPoolExecutor(max_workers=n_jobs, initializer=_fold_worker_init,
+                                       initargs=(_picklable(X), y, folds))
+            data = {}
+        elif self.backend == 'thread':
+            pool = ThreadPoolExecutor(max_workers=n_jobs)
+            data = dict(slices=_FoldSlices(X, y, folds, len(todo)))
+        else:
+            raise ValueError("backend must be 'process' or 'thread', got %r" % (self.backend,))
 
-            for j, (train_idx, test_idx) in enumerate(folds):
-                X_train = X[train_idx]
-                y_train = y[train_idx]
-                X_holdout = X[test_idx]
-#                y_holdout = y[test_idx]
+        n_left = {i: self.n_splits for i in todo}
+        with pool:
+            # fold major, so that the fits sharing a fold slice run together
+            futures = [pool.submit(_fit_fold_task, i, j, _clone(self.base_models[i]), n_threads, self.meta_dtype, **data)
+                       for j in range(len(folds))
+                       for i in todo]
+            for future in as_completed(futures):
+                i, j, model, y_pred = future.result()
+                print ("Done %s fold %d" % (_model_name(self.base_models[i]), j+1))
 
-                print ("Fit %s fold %d" % (str(clf).split('(')[0], j+1))
-                clf.fit(X_train, y_train)
-#                cross_score = cross_val_score(clf, X_train, y_train, cv=3, scoring='roc_auc')
-#                print("    cross_score: %.5f" % (cross_score.mean()))
-                y_pred = clf.predict_proba(X_holdout)[:,1]                
+                S_train[folds[j][1], i] = y_pred
+                fold_models[i][j] = model
+                n_left[i] -= 1
+                if n_left[i] == 0:
+                    self._model_done(i, S_train, fold_models, keys)
 
-                S_train[test_idx, i] = y_pred
-                S_test_i[:, j] = clf.predict_proba(T)[:,1]
-            S_test[:, i] = S_test_i.mean(axis=1)
+    def fit(self, X, y):
+        X = _as_array(X)
+        y = _as_array(y)
+
+        folds = list(StratifiedKFold(n_splits=self.n_splits, shuffle=True, random_state=self.random_state).split(X, y))
+
+        S_train = np.zeros((X.shape[0], len(self.base_models)), dtype=self.meta_dtype)
+        fold_models = [[None] * self.n_splits for clf in self.base_models]
+
+        todo = list(range(len(self.base_models)))
+        keys = None
+        if self.cache_dir is not None:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            data_key = (self.n_splits, self.random_state, np.dtype(self.meta_dtype).str, _fingerprint(X), _fingerprint(y))
+            keys = [_model_key(clf, data_key) for clf in self.base_models]
+            todo = []
+            for i, clf in enumerate(self.base_models):
+                cached = _load_fold_models(self.cache_dir, keys[i])
+                if cached is None:
+                    todo.append(i)
+                else:
+                    print ("Loaded %s from cache" % _model_name(clf))
+                    S_train[:, i], fold_models[i] = cached
+
+        if self.n_jobs != 1:
+            self._fit_base_models_parallel(X, y, folds, S_train, fold_models, todo, keys)
+        else:
+            slices = _FoldSlices(X, y, folds, len(todo))
+            for j, (train_idx, test_idx) in enumerate(folds):
+                for i in todo:
+                    clf = _clone(self.base_models[i])
+                    print ("Fit %s fold %d" % (_model_name(clf), j+1))
+#                    cross_score = cross_val_score(clf, X[train_idx], y[train_idx], cv=3, scoring='roc_auc')
+#                    print("    cross_score: %.5f" % (cross_score.mean()))
+                    fold_models[i][j], S_train[test_idx, i] = _fit_fold(clf, slices, j, self.meta_dtype)
+                    if j == self.n_splits - 1:
+                        self._model_done(i, S_train, fold_models, keys)
 
         results = cross_val_score(self.stacker, S_train, y, cv=3, scoring='roc_auc')
         print("Stacker score: %.5f" % (results.mean()))
 
         self.stacker.fit(S_train, y)
-        res = self.stacker.predict_proba(S_test)[:,1]
+        self.fold_models_ = fold_models
+        return self
+
+    def _meta_features(self, batch, pool):
+        '''S_test rows of one batch: each base model's fold predictions, averaged in fold order.'''
+        models = [model for models in self.fold_models_ for model in models]
+        if pool is None:
+            preds = (_positive_proba(model, batch) for model in models)
+        else:
+            preds = pool.map(_positive_proba, models, [batch] * len(models))
+        S_test = np.zeros((batch.shape[0], len(self.fold_models_)), dtype=self.meta_dtype)
+        for k, pred in enumerate(preds):
+            S_test[:, k // self.n_splits] += pred.astype(self.meta_dtype)
+        S_test /= self.n_splits
+        return S_test
+
+    def _iter_meta_features(self, T):
+        # fold models predict in a thread pool (boosters release the GIL), one chunk of T at a time
+        pool = ThreadPoolExecutor(max_workers=self._get_n_jobs()) if self.n_jobs != 1 else None
+        try:
+            for start in range(0, T.shape[0], self.chunk_rows):
+                yield start, self._meta_features(T[start:start + self.chunk_rows], pool)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def predict_meta(self, T):
+        '''The meta features S_test of T (rows x base models), chunk_rows rows at a time.'''
+        T = _as_array(T)
+        S_test = np.empty((T.shape[0], len(self.fold_models_)), dtype=self.meta_dtype)
+        for start, S_chunk in self._iter_meta_features(T):
+            S_test[start:start + len(S_chunk)] = S_chunk
+        return S_test
+
+    def predict(self, T):
+        '''Stacker class 1 probabilities for T with the fitted fold models (see fit), chunk_rows rows at a time.'''
+        T = _as_array(T)
+        res = np.empty(T.shape[0])
+        for start, S_chunk in self._iter_meta_features(T):
+            res[start:start + len(S_chunk)] = _positive_proba(self.stacker, S_chunk)
         return res
+
+    def fit_predict(self, X, y, T):
+        return self.fit(X, y).predict(T)
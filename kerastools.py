@@ -1,35 +1,199 @@
 '''
 @author Vineeth_Bhaskara
 '''
-# For Python 2
-# Tested on Keras 2.0.8 on Python 2
+# Python 3, Keras 2 API (Sequence, fit_generator/predict_generator)
+# Tested on tf.keras 2.15
 
+import os
+import shutil
+import multiprocessing
+import threading
+import traceback
+import numpy as np
+import xmetrics # Compiled (numba, cached) metric kernels
+import mltools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.metrics import roc_auc_score, log_loss
 from keras.callbacks import Callback
-from keras.utils.data_utils import Sequence
+from keras.utils import Sequence
 
 
-class ModelCheckpointAUC(keras.callbacks.Callback):
+def _stratified_subsample(y, size, seed=28081994):
+    '''Sorted row indices of a fixed stratified subsample of y (one hot or labels); size is a row count or a fraction.'''
+    y = np.asarray(y)
+    labels = y.argmax(axis=1) if y.ndim == 2 else y
+    n = len(labels)
+    if size < 1:
+        size = int(round(size * n))
+    if size >= n:
+        return np.arange(n)
+    rng = np.random.RandomState(seed)
+    picked = []
+    for label in np.unique(labels):
+        rows = np.flatnonzero(labels == label)
+        picked.append(rng.choice(rows, max(1, int(round(size * len(rows) / float(n)))), replace=False))
+    return np.sort(np.concatenate(picked))
+
+
+def _auc_logloss(true_y, y_pred):
+    '''
+    roc_auc_score and log_loss of the predictions, as sklearn gives them for one hot (or 1-D) binary labels, with the
+    xmetrics kernels and a single sort of the class 1 scores. More than 2 classes go to sklearn.
+    '''
+    true_y = np.asarray(true_y)
+    y_pred = np.asarray(y_pred)
+    if y_pred.ndim == 2 and y_pred.shape[1] > 2:
+        return roc_auc_score(true_y, y_pred), log_loss(true_y, y_pred)
+    if y_pred.ndim == 2 and y_pred.shape[1] == 2:
+        score = y_pred[:, 1]
+        lloss = xmetrics.multiclass_logloss(true_y, y_pred)
+        true_y = true_y[:, 1] if true_y.ndim == 2 else true_y
+    else:
+        score = y_pred.ravel()
+        true_y = true_y.ravel()
+        lloss = xmetrics.logloss(true_y, score)
+    return xmetrics.auc(true_y, score, xmetrics.sort_order(score)), lloss
+
+
+def _replace_path(tmp, path):
+    # a file (h5, .keras) is renamed over path; a SavedModel directory takes the place of the old one
+    if os.path.isdir(path):
+        old = path + '.old'
+        shutil.rmtree(old, ignore_errors=True)
+        os.rename(path, old)
+        os.rename(tmp, path)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        os.replace(tmp, path)
+
+
+class AsyncModelSaver(object):
+    '''
+    Saves models to disk on a background thread so that training goes on right away. save() only snapshots the
+    weights in memory (model.get_weights()); the thread copies them into a clone of the model (made once, with
+    keras.models.clone_model) and writes it with the clone's own save, so the format follows the extension of
+    filepath as with model.save. It is written next to filepath (name.tmp.ext) and renamed over it, so a crash
+    never leaves a half written checkpoint. Only the latest pending save is kept: a newer snapshot replaces one
+    that has not started writing yet. extra_files: {path: text} written (atomically) after the model.
+    
+    The clone is not compiled, so the checkpoints load with keras.models.load_model without the optimizer
+    state (model.save is synchronous for that). Call close() when done, it stops the thread.
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = None
+        self._busy = False
+        self._error = None
+        self._closed = False
+        self._clones = {} # id(model) -> clone_model(model), written from the background thread only
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, model, filepath, extra_files=None):
+        if id(model) not in self._clones:
+            from keras.models import clone_model
+            self._clones[id(model)] = clone_model(model)
+        job = (filepath, self._clones[id(model)], model.get_weights(), extra_files or {})
+        with self._cond:
+            self._raise_error()
+            self._pending = job # drops an older snapshot still waiting
+            self._cond.notify_all()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Background model save failed:\n' + error)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+                job, self._pending = self._pending, None
+                self._busy = True
+            filepath, clone, weights, extra_files = job
+            try:
+                root, ext = os.path.splitext(filepath)
+                tmp = root + '.tmp' + ext # keeps the extension, which picks the format
+                clone.set_weights(weights)
+                clone.save(tmp)
+                _replace_path(tmp, filepath)
+                for path, text in extra_files.items():
+                    with open(path + '.tmp', 'w') as f:
+                        f.write(text)
+                    os.rename(path + '.tmp', path)
+            except Exception:
+                with self._cond:
+                    self._error = traceback.format_exc()
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def flush(self):
+        '''Waits until the pending save (if any) is on disk.'''
+        with self._cond:
+            while self._pending is not None or self._busy:
+                self._cond.wait()
+            self._raise_error()
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+
+class ModelCheckpointAUC(Callback):
     '''
     Save the model at the filepath specified. Pass val_data as a tuple of numpy data and labels, val_data=(val_x,val_y).
     For FP/TP sensitive problems, we would like to Save/Monitor by the AUC score to save the model.
+    
+    Evaluation cost:
+    train_subsample: evaluate the train metrics on a fixed stratified subsample of train_data instead of all of
+    it - a number of rows, or a fraction if < 1. Drawn once, so the train metrics stay comparable across epochs.
+    eval_every: evaluate (and checkpoint) only every eval_every epochs, and on the last epoch.
+    train_eval_every: evaluate the train metrics only on every train_eval_every-th evaluation (nan otherwise).
+    The validation AUC - and so the checkpoint decision - is always on the full val_data. AUC and log loss come
+    from the compiled xmetrics kernels with one sort of the predictions.
+    
+    async_save: take a snapshot of the weights and write the checkpoint (and .metrics.txt) on a background
+    thread (see AsyncModelSaver: same format, no optimizer state), instead of pausing training in model.save.
+    The saver is started in on_train_begin; on_train_end waits for the last save and stops it.
+    The log file is kept open (buffered) during training, flushed on checkpoints and closed at the end of training.
     '''
     
-    def __init__(self, val_data, filepath=None, save_model=False, train_data=None, batch_size=256, logfile='./keras_log.log'):
+    def __init__(self, val_data, filepath=None, save_model=False, train_data=None, batch_size=256, logfile='./keras_log.log',
+                 train_subsample=None, eval_every=1, train_eval_every=1, async_save=False):
+        super(ModelCheckpointAUC, self).__init__()
         self.logfile=logfile
         self.batch_size=batch_size
+        self.eval_every = eval_every
+        self.train_eval_every = train_eval_every
         self.validation_data = DataGen(val_data[0], val_data[1], batch_size=self.batch_size, shuffle=False,
                       onehot_y=True)
         self.true_y = val_data[1]
         
+        self.train_data = None
         if train_data is not None:
-            self.true_y_train = train_data[1]
-            self.train_data = DataGen(train_data[0], train_data[1], batch_size=self.batch_size, shuffle=False,
+            train_x, train_y = train_data[0], train_data[1]
+            if train_subsample is not None:
+                rows = _stratified_subsample(train_y, train_subsample)
+                train_x, train_y = train_x[rows], train_y[rows]
+            self.true_y_train = train_y
+            self.train_data = DataGen(train_x, train_y, batch_size=self.batch_size, shuffle=False,
                       onehot_y=True)
         self.save_model=False
         if save_model:
             self.filepath = filepath
             self.save_model = True
+        self.async_save = async_save
+        self.saver = None
         
         with open(self.logfile, 'a') as f:
             f.write('\n\n===================================\n')
@@ -37,6 +201,9 @@ class ModelCheckpointAUC(keras.callbacks.Callback):
         
     
     def on_train_begin(self, logs={}):
+        self.log = open(self.logfile, 'a')
+        if self.async_save and self.save_model:
+            self.saver = AsyncModelSaver()
         self.aucs = [] # validation auc history
         self.losses = []
         self.vallloss = []
@@ -44,12 +211,17 @@ class ModelCheckpointAUC(keras.callbacks.Callback):
         
         self.trainlloss = []
         self.trainaucs = []
+        self.eval_epochs = [] # epochs the metrics above are for
 
     def on_train_end(self, logs={}):
-        print 'Validation AUC History: ', self.aucs
-        print 'Validation Loss History: ', self.vallloss
-        print 'Train AUC History: ', self.trainaucs
-        print 'Train Loss History: ', self.trainlloss
+        print('Validation AUC History: ', self.aucs)
+        print('Validation Loss History: ', self.vallloss)
+        print('Train AUC History: ', self.trainaucs)
+        print('Train Loss History: ', self.trainlloss)
+        self.log.close()
+        if self.saver is not None:
+            self.saver.close() # waits for the last checkpoint
+            self.saver = None
         return
 
     def on_epoch_begin(self, epoch, logs={}):
@@ -58,36 +230,45 @@ class ModelCheckpointAUC(keras.callbacks.Callback):
     def on_epoch_end(self, epoch, logs={}):
         self.losses.append(logs.get('loss'))
         
+        last_epoch = self.params.get('epochs') if hasattr(self, 'params') else None
+        if (epoch + 1) % self.eval_every != 0 and epoch + 1 != last_epoch:
+            return
+        self.eval_epochs.append(epoch)
+        
         y_pred = self.model.predict_generator(self.validation_data, len(self.validation_data))
-        auc_now_val = roc_auc_score(self.true_y, y_pred)
-        lloss_now_val = log_loss(self.true_y, y_pred)
+        auc_now_val, lloss_now_val = _auc_logloss(self.true_y, y_pred)
         self.aucs.append(auc_now_val)
         self.vallloss.append(lloss_now_val)
         
-        y_pred_train = self.model.predict_generator(self.train_data, len(self.train_data))
-        auc_now_tr = roc_auc_score(self.true_y_train, y_pred_train)
-        lloss_now_tr = log_loss(self.true_y_train, y_pred_train)
+        auc_now_tr, lloss_now_tr = np.nan, np.nan
+        if self.train_data is not None and (len(self.eval_epochs) - 1) % self.train_eval_every == 0:
+            y_pred_train = self.model.predict_generator(self.train_data, len(self.train_data))
+            auc_now_tr, lloss_now_tr = _auc_logloss(self.true_y_train, y_pred_train)
         self.trainaucs.append(auc_now_tr)
         self.trainlloss.append(lloss_now_tr)
         
-        with open(self.logfile, 'a') as f:
-            # 'TR_LOSS\tVAL_LOSS\tTR_AUC\tVAL_AUC\n'
-            f.write('{}\t{}\t{}\t{}\n'.format(lloss_now_tr, lloss_now_val, auc_now_tr, auc_now_val))
+        # 'TR_LOSS\tVAL_LOSS\tTR_AUC\tVAL_AUC\n'
+        self.log.write('{}\t{}\t{}\t{}\n'.format(lloss_now_tr, lloss_now_val, auc_now_tr, auc_now_val))
             
-        print '\nEpoch Metrics: train_auc: {}, train_loss: {}, val_auc: {}, val_loss: {}'.format(str(round(auc_now_tr,4)), str(round(lloss_now_tr,4)), str(round(auc_now_val,4)), str(round(lloss_now_val,4))),'\n'
+        print('\nEpoch Metrics: train_auc: {}, train_loss: {}, val_auc: {}, val_loss: {}'.format(str(round(auc_now_tr,4)), str(round(lloss_now_tr,4)), str(round(auc_now_val,4)), str(round(lloss_now_val,4))),'\n')
         
         if self.save_model:
             if self.max_auc < auc_now_val:
                 print('Saving model to '+self.filepath+' as better val auc.')
-                self.model.save(self.filepath, overwrite=True)
                 self.max_auc = auc_now_val
+                self.log.flush()
                 
                 # also note the metric down
-                with open(self.filepath+'.metrics.txt', 'w') as f:
-                    f.write('VAL AUC: ' + str(auc_now_val) + '\n')
-                    f.write('VAL Loss: ' + str(lloss_now_val) + '\n')
-                    f.write('Train AUC: ' + str(auc_now_tr) + '\n')
-                    f.write('Train Loss: ' + str(lloss_now_tr) + '\n')
+                metrics = ('VAL AUC: ' + str(auc_now_val) + '\n' +
+                           'VAL Loss: ' + str(lloss_now_val) + '\n' +
+                           'Train AUC: ' + str(auc_now_tr) + '\n' +
+                           'Train Loss: ' + str(lloss_now_tr) + '\n')
+                if self.saver is not None:
+                    self.saver.save(self.model, self.filepath, {self.filepath+'.metrics.txt': metrics})
+                else:
+                    self.model.save(self.filepath, overwrite=True)
+                    with open(self.filepath+'.metrics.txt', 'w') as f:
+                        f.write(metrics)
         return
 
     def on_batch_begin(self, batch, logs={}):
@@ -101,30 +282,316 @@ class DataGen(Sequence):
     '''
     Just pass in numpy arrays of data and there you go! You get a generator that will return batches of data
     w/wo shuffling. You may add more transformations here if you need.
+    
+    x_set/y_set are never copied (np.memmap of any size is fine): with shuffle, a permutation of the row indices
+    is redrawn every epoch and each batch is gathered from it - in sorted order, so memmaps are read front to
+    back - into preallocated batch buffers. y_set may be one hot or 1-D (onehot_y is not needed anymore).
+    
+    n_buffers: batch buffers reused round robin (batch idx goes to buffer idx % n_buffers). A returned batch
+    stays valid until n_buffers more batches have been fetched, so keep it above the max_queue_size + workers
+    of fit_generator/predict_generator (10 + 1 by default).
     '''
 
-    def __init__(self, x_set, y_set, batch_size, shuffle=True, onehot_y=True, seed=28081994):
-        np.random.seed(seed)
+    def __init__(self, x_set, y_set, batch_size, shuffle=True, onehot_y=True, seed=28081994, n_buffers=16):
         self.x, self.y = x_set, y_set
         self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        self.index = np.arange(self.x.shape[0])
         if shuffle:
-            tot = np.arange(self.x.shape[0])
-            np.random.shuffle(tot)
-            self.x = self.x[tot, :]
-            if onehot_y:
-                self.y = self.y[tot, :]
-            else:
-                self.y = self.y[tot]
+            self.rng.shuffle(self.index)
         
+        self.n_buffers = n_buffers
+        self.x_buffers = [np.empty((batch_size,) + self.x.shape[1:], dtype=self.x.dtype) for i in range(n_buffers)]
+        self.y_buffers = [np.empty((batch_size,) + self.y.shape[1:], dtype=self.y.dtype) for i in range(n_buffers)]
 
     def __len__(self):
-        return int(np.ceil(len(self.x) / float(self.batch_size)))
+        return int(np.ceil(len(self.index) / float(self.batch_size)))
 
     def on_epoch_end(self):
-        pass
+        if self.shuffle:
+            self.rng.shuffle(self.index)
 
     def __getitem__(self, idx):
-        batch_x = self.x[idx * self.batch_size:(idx + 1) * self.batch_size]
-        batch_y = self.y[idx * self.batch_size:(idx + 1) * self.batch_size]
+        start = idx * self.batch_size
+        stop = min(start + self.batch_size, len(self.index))
+        batch_x = self.x_buffers[idx % self.n_buffers][:stop - start]
+        batch_y = self.y_buffers[idx % self.n_buffers][:stop - start]
+        
+        if self.shuffle:
+            rows = np.sort(self.index[start:stop])
+            np.take(self.x, rows, axis=0, out=batch_x, mode='clip') # indices are valid, 'clip' avoids a buffered copy
+            np.take(self.y, rows, axis=0, out=batch_y, mode='clip')
+        else:
+            batch_x[...] = self.x[start:stop]
+            batch_y[...] = self.y[start:stop]
+
+        return batch_x, batch_y
+
+
+class ImageDataGen(Sequence):
+    '''
+    DataGen over image files instead of an in memory array: pass a list of image paths and their labels. Each batch
+    is read and preprocessed on demand with the get_im_cv2 steps (mltools.preprocess_im_cv2), so training starts
+    right away and RAM scales with the cache, not the dataset.
+    
+    size, sharpen_kernel, equalize: as in mltools.get_im_cv2. Batches are uint8 (rows, size[1], size[0], 3).
+    cache_size: number of preprocessed images kept in memory (least recently used are dropped); 0 disables it.
+    cache_dir: optional on-disk cache of preprocessed images, keyed by file content and settings - the same
+    cache as mltools.preprocess_images, so either can warm it for the other.
+    n_jobs: threads decoding the images of a batch (cv2 releases the GIL).
+    shuffle, seed, n_buffers: as in DataGen (per epoch permutation, batch buffers reused round robin).
+    
+        gen = ImageDataGen(train_paths, train_y, 64, size=(224, 224), cache_size=20000, cache_dir='./im_cache')
+        model.fit_generator(PrefetchGen(gen, n_workers=2), len(gen), epochs=10)
+    '''
+
+    def __init__(self, paths, y_set, batch_size, size=(224, 224), sharpen_kernel=mltools.kernel_sharpen_3,
+                 equalize='yuv', cache_size=10000, cache_dir=None, n_jobs=4, shuffle=True, seed=28081994, n_buffers=16):
+        self.paths = list(paths)
+        self.y = y_set
+        self.batch_size = batch_size
+        self.size = size
+        self.sharpen_kernel = sharpen_kernel
+        self.equalize = equalize
+        self.settings_key = mltools._preprocess_settings_key(size, sharpen_kernel, equalize)
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.cache = OrderedDict() # row -> preprocessed image, most recently used last
+        self.n_jobs = n_jobs
+        self._init_threads()
+        
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        self.index = np.arange(len(self.paths))
+        if shuffle:
+            self.rng.shuffle(self.index)
+        
+        self.n_buffers = n_buffers
+        self.x_buffers = [np.empty((batch_size, size[1], size[0], 3), dtype=np.uint8) for i in range(n_buffers)]
+        self.y_buffers = [np.empty((batch_size,) + self.y.shape[1:], dtype=self.y.dtype) for i in range(n_buffers)]
+
+    def __len__(self):
+        return int(np.ceil(len(self.index) / float(self.batch_size)))
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.index)
+
+    def _init_threads(self):
+        # also after unpickling or a fork (eg. PrefetchGen with processes): the parent's pool threads are not copied
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=self.n_jobs) if self.n_jobs > 1 else None
+        self.pid = os.getpid()
+
+    def load(self, row):
+        '''Preprocessed image of paths[row], from the memory cache, the disk cache or the file.'''
+        with self.lock:
+            img = self.cache.get(row)
+            if img is not None:
+                self.cache.pop(row)
+                self.cache[row] = img
+                return img
+        img = mltools._preprocess_im_cached(self.paths[row], self.size, self.sharpen_kernel, self.equalize,
+                                            self.cache_dir, self.settings_key)
+        if self.cache_size > 0:
+            with self.lock:
+                self.cache[row] = img
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return img
+
+    def __getitem__(self, idx):
+        start = idx * self.batch_size
+        stop = min(start + self.batch_size, len(self.index))
+        batch_x = self.x_buffers[idx % self.n_buffers][:stop - start]
+        batch_y = self.y_buffers[idx % self.n_buffers][:stop - start]
+        
+        rows = self.index[start:stop]
+        if self.shuffle:
+            rows = np.sort(rows)
+        if self.pid != os.getpid():
+            self._init_threads()
+        images = self.pool.map(self.load, rows) if self.pool is not None else map(self.load, rows)
+        for k, img in enumerate(images):
+            batch_x[k] = img
+        np.take(self.y, rows, axis=0, out=batch_y, mode='clip')
+
+        return batch_x, batch_y
+
+    def __getstate__(self):
+        # thread pools and locks do not pickle; they are recreated
+        state = self.__dict__.copy()
+        del state['pool'], state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_threads()
+
+
+def _copy_batch(sequence, idx):
+    # thread mode: copied in the worker, while the batch buffer of the sequence still holds batch idx
+    return tuple(np.array(arr) for arr in sequence[idx])
+
+
+def _prefetch_worker(sequence, tasks, results, slots):
+    # runs in a forked process: batches go into the shared memory slots, only (idx, slot, rows) is pickled back
+    views = [[np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape) for raw, dtype, shape in slot]
+             for slot in slots]
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        if task[0] == 'epoch_end':
+            sequence.on_epoch_end()
+            continue
+        _, idx, s = task
+        try:
+            batch = sequence[idx]
+            for view, arr in zip(views[s], batch):
+                view[:len(arr)] = arr
+            results.put((idx, s, len(batch[0]), None))
+        except Exception:
+            results.put((idx, s, 0, traceback.format_exc()))
+
+
+class PrefetchGen(Sequence):
+    '''
+    Prepares the next `prefetch` batches of a Sequence (eg. DataGen) in the background, so that training does not
+    wait on the slicing, copying and transforms of each batch. Batches come back in order, exactly as sequence[idx].
+    
+    n_workers: number of worker threads (default; numpy copies release the GIL) or processes.
+    use_processes: forked worker processes, each with its own copy of the sequence (memmaps are shared, not copied).
+    Batches are written into shared memory slots and copied out once in the main process, nothing big is pickled.
+    on_epoch_end is replayed in every worker, so a shuffling DataGen stays in step with the main process.
+    Create it before the model/session, as it forks.
+    
+        gen = PrefetchGen(DataGen(x, y, 256), n_workers=2, prefetch=8)
+        model.fit_generator(gen, len(gen), epochs=10)
+        gen.close() # or use it in a with block
+    
+    Either way the batches handed out are copies, owned by the caller: the reused batch buffers of DataGen /
+    ImageDataGen only have to outlast the batches in flight here, so prefetch may not exceed their n_buffers.
+    '''
+
+    def __init__(self, sequence, n_workers=2, prefetch=8, use_processes=False):
+        n_buffers = getattr(sequence, 'n_buffers', None)
+        if n_buffers is not None and prefetch > n_buffers:
+            raise ValueError('prefetch (%d) is larger than the n_buffers (%d) of the sequence: batches would be '
+                             'overwritten before they are copied out' % (prefetch, n_buffers))
+        self.sequence = sequence
+        self.n_workers = n_workers
+        self.prefetch = prefetch
+        self.use_processes = use_processes
+        self._next = 0 # next batch index to hand to the workers
+        self._pending = {} # batch index -> future (threads) or slot (processes)
+        self._closed = False
+        
+        if not use_processes:
+            self._pool = ThreadPoolExecutor(max_workers=n_workers)
+            return
+        
+        # one slot per prefetched batch, sized from the first batch
+        first = sequence[0]
+        self._slots = []
+        for s in range(prefetch):
+            slot = []
+            for arr in first:
+                arr = np.asarray(arr)
+                slot.append((multiprocessing.RawArray('b', max(arr.nbytes, 1)), arr.dtype, arr.shape))
+            self._slots.append(slot)
+        self._views = [[np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+                        for raw, dtype, shape in slot] for slot in self._slots]
+        self._free = list(range(prefetch))
+        self._done = {}
+        
+        ctx = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+        self._results = ctx.Queue()
+        self._tasks = [ctx.Queue() for w in range(n_workers)] # batch idx always goes to worker idx % n_workers
+        self._workers = [ctx.Process(target=_prefetch_worker, args=(sequence, tasks, self._results, self._slots))
+                         for tasks in self._tasks]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def _submit(self, idx):
+        if self.use_processes:
+            s = self._free.pop()
+            self._tasks[idx % self.n_workers].put(('get', idx, s))
+            self._pending[idx] = s
+        else:
+            self._pending[idx] = self._pool.submit(_copy_batch, self.sequence, idx)
+
+    def _wait(self, idx):
+        if not self.use_processes:
+            return self._pending.pop(idx).result()
+        while idx not in self._done:
+            k, s, rows, error = self._results.get()
+            self._done[k] = (s, rows, error)
+        s, rows, error = self._done.pop(idx)
+        del self._pending[idx]
+        self._free.append(s)
+        if error is not None:
+            raise RuntimeError('PrefetchGen worker failed on batch %d:\n%s' % (idx, error))
+        return tuple(np.array(view[:rows]) for view in self._views[s])
+
+    def _drain(self):
+        # waits for (and drops) every batch in flight, eg. before an epoch end or a jump to another index
+        for idx in sorted(self._pending):
+            try:
+                self._wait(idx)
+            except Exception:
+                pass
+        self._next = 0
+
+    def __getitem__(self, idx):
+        if self._closed:
+            raise RuntimeError('PrefetchGen is closed')
+        if idx not in self._pending:
+            self._drain()
+            self._next = idx
+        for k in sorted(self._pending): # batches skipped over
+            if k < idx:
+                self._wait(k)
+        while self._next < min(idx + self.prefetch, len(self)) and len(self._pending) < self.prefetch:
+            self._submit(self._next)
+            self._next += 1
+        return self._wait(idx)
+
+    def on_epoch_end(self):
+        self._drain()
+        if self.use_processes:
+            for tasks in self._tasks:
+                tasks.put(('epoch_end',))
+        self.sequence.on_epoch_end()
+
+    def close(self):
+        if self._closed:
+            return
+        self._drain()
+        self._closed = True
+        if not self.use_processes:
+            self._pool.shutdown()
+            return
+        for tasks in self._tasks:
+            tasks.put(None)
+        for worker in self._workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-        return np.array(batch_x), np.array(batch_y)
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -0,0 +1,32 @@
+'''
+Deferred imports for the heavy optional dependencies of xtune/mltools (cv2, matplotlib, seaborn, xgboost,
+lightgbm, sklearn, scipy...), so that importing the tuner - eg. in every worker of a process pool - stays
+fast, and machines without, say, cv2 can still use everything that does not need it.
+
+    cv2 = LazyModule('cv2')        # nothing imported yet
+    img = cv2.imread(path)         # cv2 is imported here, on first attribute access
+'''
+import importlib
+
+
+class LazyModule(object):
+    '''Stands in for a module and imports it on first attribute access.'''
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded yet'
+        return "<lazy module '%s' (%s)>" % (self._name, state)
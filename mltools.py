@@ -9,16 +9,26 @@ import pandas as pd
 import pickle
 import os
 import sys
-import bcolz
-import cv2
 import hashlib
+import mmap
+import json
+import zlib
+import sqlite3
+import threading
 import random, math
-from xtune import *
-from sklearn.metrics import roc_auc_score, log_loss
-from sklearn.metrics import confusion_matrix
-import matplotlib.pyplot as plt
-import seaborn as sns
 import itertools
+import xmetrics
+from lazyimport import LazyModule
+
+# Heavy dependencies are imported on first use (see lazyimport)
+cv2 = LazyModule('cv2')
+plt = LazyModule('matplotlib.pyplot')
+sns = LazyModule('seaborn')
+sk_metrics = LazyModule('sklearn.metrics')
+scipy_stats = LazyModule('scipy.stats')
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
+from collections.abc import Mapping
 
 
 def plot_confusion_matrix(y_true, y_pred, 
@@ -61,32 +71,19 @@ def plot_confusion_matrix(y_true, y_pred,
     Citiation
     ---------
     http://scikit-learn.org/stable/auto_examples/model_selection/plot_confusion_matrix.html
+    
+    To choose the cutoff, see threshold_sweep and find_best_cutoff.
     """
     if cutoff is not None:
-        y_pred_labels = []
-        
-        for pred in y_pred:
-            
-            probab = None
-            try: 
-                probab = pred[1]
-            except:
-                if isinstance(pred, int):
-                    probab = pred
-                else:
-                    raise
-
-            if probab > cutoff:
-                y_pred_labels.append(1)
-            else:
-                y_pred_labels.append(0)
-        
-        y_pred = y_pred_labels
+        probab = np.asarray(y_pred)
+        if probab.ndim == 2:
+            probab = probab[:, 1]
+        y_pred = (probab > cutoff).astype(int)
     
-    target_names = target_names_map.values()
-    labels = target_names_map.keys()
+    target_names = list(target_names_map.values())
+    labels = list(target_names_map.keys())
     
-    cm = confusion_matrix(y_true, y_pred, labels=labels)
+    cm = sk_metrics.confusion_matrix(y_true, y_pred, labels=labels)
 
     accuracy = np.trace(cm) / float(np.sum(cm))
     misclass = 1 - accuracy
@@ -136,6 +133,94 @@ def plot_confusion_matrix(y_true, y_pred,
     
     return cm
     
+def threshold_sweep(y_true, y_prob, thresholds=None, order=None):
+    '''
+    Headless companion of plot_confusion_matrix for picking operating points on big data.
+    
+    Sorts the scores once and, from cumulative sums of the labels, gets the confusion counts and
+    precision, recall, f1, accuracy (and tpr/fpr) at every threshold - class 1 is predicted when
+    y_prob > threshold, as with the cutoff of plot_confusion_matrix.
+    
+    y_true: binary labels
+    y_prob: class 1 probabilities (1D), or (n_samples, 2) predictions from which column 1 is used
+    thresholds: None for every distinct score, or a fixed grid, eg. np.linspace(0, 1, 101)
+    order: xmetrics.sort_order(y_prob) if already computed
+    
+    Returns a DataFrame with one row per threshold:
+    threshold, tp, fp, fn, tn, precision, recall, f1, accuracy, tpr, fpr
+    '''
+    y_prob = np.asarray(y_prob)
+    if y_prob.ndim == 2:
+        y_prob = y_prob[:, 1]
+    y_true = np.asarray(y_true)
+    if order is None:
+        order = xmetrics.sort_order(y_prob)
+    sorted_prob = y_prob[order]
+    cumpos = np.concatenate([[0], np.cumsum(y_true[order] == 1)])
+    
+    if thresholds is None:
+        thresholds = np.unique(sorted_prob)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    
+    n = len(y_true)
+    npos = cumpos[-1]
+    nneg = n - npos
+    below = np.searchsorted(sorted_prob, thresholds, side='right') # predicted 0: y_prob <= threshold
+    fn = cumpos[below]
+    tn = below - fn
+    tp = npos - fn
+    fp = nneg - tn
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(tp + fp > 0, tp / np.maximum(tp + fp, 1).astype(float), 0.0)
+        recall = tp / float(npos) if npos > 0 else np.zeros(len(thresholds))
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+        fpr = fp / float(nneg) if nneg > 0 else np.zeros(len(thresholds))
+    
+    return pd.DataFrame({'threshold': thresholds, 'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn,
+                         'precision': precision, 'recall': recall, 'f1': f1,
+                         'accuracy': (tp + tn) / float(n), 'tpr': recall, 'fpr': fpr},
+                        columns=['threshold', 'tp', 'fp', 'fn', 'tn', 'precision', 'recall', 'f1',
+                                 'accuracy', 'tpr', 'fpr'])
+    
+    
+def find_best_cutoff(y_true, y_prob, objective='f1', thresholds=None, sweep=None):
+    '''
+    Optimal cutoff for plot_confusion_matrix from threshold_sweep.
+    
+    objective: a column of threshold_sweep to maximize ('f1', 'accuracy', 'precision', 'recall', ...),
+    'youden' for tpr - fpr, or a function taking the sweep DataFrame and returning one score per row.
+    sweep: reuse an already computed threshold_sweep instead of y_true/y_prob/thresholds.
+    
+    Returns: best cutoff, and the sweep row (confusion counts and metrics) at that cutoff.
+    '''
+    if sweep is None:
+        sweep = threshold_sweep(y_true, y_prob, thresholds=thresholds)
+    if callable(objective):
+        scores = np.asarray(objective(sweep))
+    elif objective == 'youden':
+        scores = (sweep['tpr'] - sweep['fpr']).values
+    else:
+        scores = sweep[objective].values
+    best = int(np.argmax(scores))
+    return sweep['threshold'].values[best], sweep.iloc[best]
+
+
+def plot_threshold_sweep(sweep, metrics=['precision', 'recall', 'f1'], cutoff=None, plt_show=True):
+    '''Plots metrics of a threshold_sweep against the threshold, optionally marking a chosen cutoff.'''
+    plt.figure(figsize=(8, 6))
+    for m in metrics:
+        plt.plot(sweep['threshold'].values, sweep[m].values, label=m)
+    if cutoff is not None:
+        plt.axvline(cutoff, color='grey', linestyle='--')
+    plt.xlabel('Threshold')
+    plt.legend()
+    if plt_show:
+        plt.show()
+    else:
+        plt.close()
+    
+    
 def normalizedf(df):
     '''
     Normalizes dataframe columns to 1. Send in slice of those columns
@@ -145,18 +230,24 @@ def normalizedf(df):
     return df
     
     
-def dfcorrelationsplot(df):
+def dfcorrelationsplot(df, plot=True):
     '''
     Just using the simple df.corr() of pandas in addition to ready made easy plot
     for visualizing feature correlations
     
     df: send in the features+target columns only
-    '''
-    sns.set(style="white")
+    plot: set False to only get the matrix back
     
+    For wide frames (thousands of features) use correlation_pairs / correlated_groups instead.
+    '''
     # Compute the correlation matrix
     corr = df.corr()
     
+    if not plot:
+        return corr
+    
+    sns.set(style="white")
+    
     # Set up the matplotlib figure
     f, ax = plt.subplots(figsize=(11, 9))
     
@@ -170,6 +261,142 @@ def dfcorrelationsplot(df):
     plt.show()
     return corr
 
+
+def correlation_pairs(data, top_k=100, threshold=None, block_size=1024, chunk_rows=None, return_matrix=False):
+    '''
+    Correlation engine for wide frames - dfcorrelationsplot without the float64 p x p matrix and the heatmap.
+    
+    Columns are standardized in float32 and the Pearson correlations are computed block_size columns at a
+    time against all the later columns, so only a block_size x p slab is in memory at once.
+    
+    data: DataFrame (numeric columns are used) or 2D numpy array/memmap
+    top_k: return the top_k most correlated pairs (by absolute correlation)
+    threshold: instead return every pair with absolute correlation >= threshold
+    chunk_rows: if given, rows are streamed chunk_rows at a time (eg. for a memmap larger than RAM) - one pass
+    for the column means/stds plus one pass per column block. Otherwise the standardized float32 copy of
+    the data is built once.
+    return_matrix: also return the dense p x p float32 correlation DataFrame.
+    
+    Missing values are treated as the column mean (ie. they add nothing to the correlation) and constant
+    columns get correlation 0, unlike the pairwise NaN handling of df.corr().
+    
+    Returns: DataFrame of pairs with columns col1, col2, corr sorted by |corr| descending
+    (and the matrix if return_matrix).
+    '''
+    if isinstance(data, pd.DataFrame):
+        data = data.select_dtypes(include=[np.number])
+        columns = list(data.columns)
+        get_chunk = lambda s, e: data.iloc[s:e].values.astype(np.float32)
+    else:
+        columns = list(range(data.shape[1]))
+        get_chunk = lambda s, e: np.asarray(data[s:e], dtype=np.float32)
+    n, p = data.shape
+    step = n if chunk_rows is None else chunk_rows
+    
+    # column moments in float64, one pass
+    sums = np.zeros(p)
+    sumsq = np.zeros(p)
+    counts = np.zeros(p)
+    for start in range(0, n, step):
+        x = get_chunk(start, start+step)
+        finite = np.isfinite(x)
+        x = np.where(finite, x, 0).astype(np.float64)
+        sums += x.sum(axis=0)
+        sumsq += (x**2).sum(axis=0)
+        counts += finite.sum(axis=0)
+    mean = sums / np.maximum(counts, 1)
+    std = np.sqrt(np.maximum(sumsq / np.maximum(counts, 1) - mean**2, 0))
+    # scaled so that Z.T.dot(Z) is the correlation matrix
+    scale = np.where(std > 0, 1.0 / (std * np.sqrt(np.maximum(counts, 1))), 0).astype(np.float32)
+    mean = mean.astype(np.float32)
+    
+    def standardized(start, end):
+        z = (get_chunk(start, end) - mean) * scale
+        z[~np.isfinite(z)] = 0
+        return z
+    
+    Z = standardized(0, n) if chunk_rows is None else None
+    
+    matrix = np.zeros((p, p), dtype=np.float32) if return_matrix else None
+    found_i, found_j, found_c = [], [], []
+    
+    for bi in range(0, p, block_size):
+        be = min(bi + block_size, p)
+        if Z is not None:
+            slab = Z[:, bi:be].T.dot(Z[:, bi:])
+        else:
+            slab = np.zeros((be - bi, p - bi), dtype=np.float32)
+            for start in range(0, n, chunk_rows):
+                z = standardized(start, start+chunk_rows)
+                slab += z[:, bi:be].T.dot(z[:, bi:])
+        np.clip(slab, -1, 1, out=slab)
+        
+        if matrix is not None:
+            matrix[bi:be, bi:] = slab
+            matrix[bi:, bi:be] = slab.T
+        
+        # strictly upper triangle: slab[r, c] is the pair (bi+r, bi+c)
+        rows, cols = np.triu_indices(be - bi, 1, slab.shape[1])
+        vals = slab[rows, cols]
+        if threshold is not None:
+            keep = np.abs(vals) >= threshold
+        elif top_k is not None and len(vals) > top_k:
+            keep = np.argpartition(-np.abs(vals), top_k)[:top_k]
+        else:
+            keep = slice(None)
+        found_i.append(rows[keep] + bi)
+        found_j.append(cols[keep] + bi)
+        found_c.append(vals[keep])
+        
+        if threshold is None and top_k is not None: # trim the running candidates back to top_k
+            fi, fj, fc = np.concatenate(found_i), np.concatenate(found_j), np.concatenate(found_c)
+            if len(fc) > top_k:
+                keep = np.argpartition(-np.abs(fc), top_k)[:top_k]
+                fi, fj, fc = fi[keep], fj[keep], fc[keep]
+            found_i, found_j, found_c = [fi], [fj], [fc]
+    
+    fi, fj, fc = np.concatenate(found_i), np.concatenate(found_j), np.concatenate(found_c)
+    order = np.argsort(-np.abs(fc), kind='mergesort')
+    pairs = pd.DataFrame({'col1': [columns[i] for i in fi[order]], 'col2': [columns[j] for j in fj[order]],
+                          'corr': fc[order]}, columns=['col1', 'col2', 'corr'])
+    
+    if return_matrix:
+        np.fill_diagonal(matrix, 1)
+        return pairs, pd.DataFrame(matrix, index=columns, columns=columns)
+    return pairs
+
+
+def correlated_groups(data, threshold=0.95, **kwargs):
+    '''
+    Groups of columns connected by absolute correlation >= threshold (via correlation_pairs, kwargs passed on),
+    largest group first. Handy to prune redundant features before xTrain - eg. keep the first of every group:
+    
+        groups = correlated_groups(train_df[features], threshold=0.98)
+        to_drop = [c for g in groups for c in g[1:]]
+    '''
+    pairs = correlation_pairs(data, threshold=threshold, **kwargs)
+    parent = {}
+    
+    def find(c):
+        while parent[c] != c:
+            parent[c] = parent[parent[c]]
+            c = parent[c]
+        return c
+    
+    for c1, c2 in zip(pairs['col1'], pairs['col2']):
+        parent.setdefault(c1, c1)
+        parent.setdefault(c2, c2)
+        r1, r2 = find(c1), find(c2)
+        if r1 != r2:
+            parent[r2] = r1
+    
+    groups = {}
+    order = list(data.columns) if isinstance(data, pd.DataFrame) else list(range(data.shape[1]))
+    for c in order:
+        if c in parent:
+            groups.setdefault(find(c), []).append(c)
+    return sorted(groups.values(), key=len, reverse=True)
+    
     
 # Dealing with categorical features Way 1
 def target_encode(trn_series=None, tst_series=None, target=None, min_samples_leaf=1,
@@ -291,28 +518,190 @@ def doOneHot(df1, ranges):
     
     return finaldf.copy() 
     
-def hashfile(path, blocksize = 65536, mode='binary', alg='sha256'):
-    if mode=='binary':
-        afile = open(path, 'rb')
-    elif mode=='text':
-        afile = open(path, 'r')
+class HashCache(object):
+    '''
+    On-disk cache of file hashes in a small sqlite database, used by hashfile/findDup so that
+    repeated scans over mostly unchanged folders only read new or modified files.
+    
+    Entries are keyed by (path, algorithm) and are valid only while the file's size, mtime and inode
+    still match; a stale entry is overwritten on the next hash. Call prune() to evict entries of
+    files that no longer exist and close() (or use it in a with block) to flush pending writes.
+    
+    Usage:
+        with HashCache('./hashes.sqlite') as cache:
+            dups = findDup('./images', cache=cache)
+    '''
+    
+    def __init__(self, dbfile='./hashcache.sqlite', commit_every=1000):
+        self.dbfile = dbfile
+        self.commit_every = commit_every
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(dbfile, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT, alg TEXT, size INTEGER, '
+                          'mtime INTEGER, inode INTEGER, digest TEXT, PRIMARY KEY (path, alg))')
+        self.conn.commit()
+        
+    @staticmethod
+    def _meta(path, st=None):
+        if st is None:
+            st = os.stat(path)
+        return os.path.abspath(path), st.st_size, st.st_mtime_ns, st.st_ino
+    
+    def lookup(self, path, alg, st=None):
+        '''Returns the cached digest if the file is unchanged, else None.'''
+        key, size, mtime, inode = self._meta(path, st)
+        with self.lock:
+            row = self.conn.execute('SELECT size, mtime, inode, digest FROM hashes WHERE path=? AND alg=?',
+                                    (key, alg)).fetchone()
+        if row is not None and tuple(row[:3]) == (size, mtime, inode):
+            return row[3]
+        return None
+    
+    def store(self, path, alg, digest, st=None):
+        key, size, mtime, inode = self._meta(path, st)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                              (key, alg, size, mtime, inode, digest))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.conn.commit()
+                self.pending = 0
+    
+    def prune(self, under=None):
+        '''Evicts entries of files that no longer exist (only below the folder under, if given).'''
+        with self.lock:
+            paths = [row[0] for row in self.conn.execute('SELECT DISTINCT path FROM hashes')]
+            if under is not None:
+                under = os.path.join(os.path.abspath(under), '')
+                paths = [path for path in paths if path.startswith(under)]
+            gone = [(path,) for path in paths if not os.path.isfile(path)]
+            self.conn.executemany('DELETE FROM hashes WHERE path=?', gone)
+            self.conn.commit()
+            self.pending = 0
+        return len(gone)
+    
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending = 0
+    
+    def close(self):
+        self.commit()
+        self.conn.close()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+
+def _get_hasher(alg):
     if alg=='md5':
-        hasher = hashlib.md5()
+        return hashlib.md5()
     elif alg == 'sha256':
-        hasher = hashlib.sha256()
-    else:
-        print('Bad algorithm.')
+        return hashlib.sha256()
+    print('Bad algorithm.')
+    return None
+
+
+def hashfile(path, blocksize = 65536, mode='binary', alg='sha256', use_mmap=False, cache=None):
+    '''
+    Hexdigest of the contents of the file at path.
+    
+    use_mmap: if True (binary mode only) the file is memory mapped and fed to the hasher in blocksize
+    slices without copying. Otherwise the file is read in blocksize chunks into one reused buffer.
+    Either way hashlib releases the GIL on large updates, so this can be run from a thread pool.
+    
+    cache: optional HashCache. An unchanged file (same size, mtime and inode) is answered from it
+    without being read.
+    '''
+    if cache is not None:
+        st = os.stat(path)
+        cachealg = alg if mode=='binary' else alg+'-text'
+        digest = cache.lookup(path, cachealg, st)
+        if digest is None:
+            digest = hashfile(path, blocksize=blocksize, mode=mode, alg=alg, use_mmap=use_mmap)
+            if digest is not None:
+                cache.store(path, cachealg, digest, st)
+        return digest
+    
+    hasher = _get_hasher(alg)
+    if hasher is None:
         return
-    buf = afile.read(blocksize)
-    while len(buf) > 0:
-        hasher.update(buf)
+    
+    if mode=='text':
+        afile = open(path, 'r')
         buf = afile.read(blocksize)
-    afile.close()
+        while len(buf) > 0:
+            hasher.update(buf.encode('utf-8'))
+            buf = afile.read(blocksize)
+        afile.close()
+        return hasher.hexdigest()
+    
+    with open(path, 'rb') as afile:
+        size = os.fstat(afile.fileno()).st_size
+        if use_mmap and size > 0:
+            mm = mmap.mmap(afile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                view = memoryview(mm)
+                for start in range(0, size, blocksize):
+                    hasher.update(view[start:start+blocksize])
+                view.release()
+            finally:
+                mm.close()
+        else:
+            buf = bytearray(blocksize)
+            view = memoryview(buf)
+            nread = afile.readinto(buf)
+            while nread:
+                hasher.update(view[:nread])
+                nread = afile.readinto(buf)
     return hasher.hexdigest()
-    
+
+
+def hashfile_edges(path, edgesize=65536, alg='sha256', cache=None):
+    '''
+    Cheap fingerprint of a file: hash of its first and last edgesize bytes. Two files with different
+    edge hashes (and the same size) cannot be duplicates, so this is used by findDup to prune
+    same size candidates before reading them in full.
+    '''
+    if cache is not None:
+        st = os.stat(path)
+        cachealg = alg+'-edges'+str(edgesize)
+        digest = cache.lookup(path, cachealg, st)
+        if digest is None:
+            digest = hashfile_edges(path, edgesize=edgesize, alg=alg)
+            if digest is not None:
+                cache.store(path, cachealg, digest, st)
+        return digest
+    
+    hasher = _get_hasher(alg)
+    if hasher is None:
+        return
+    with open(path, 'rb') as afile:
+        size = os.fstat(afile.fileno()).st_size
+        hasher.update(afile.read(edgesize))
+        if size > edgesize:
+            afile.seek(max(edgesize, size - edgesize))
+            hasher.update(afile.read(edgesize))
+    return hasher.hexdigest()
+
+
+def _group_paths(paths, keys):
+    groups = {}
+    for path, key in zip(paths, keys):
+        if key in groups:
+            groups[key].append(path)
+        else:
+            groups[key] = [path]
+    return groups
+
 
 # REMOVE CONTENT DUPLICATES 
-def findDup(parentFolder, listOfPaths=None, mode='binary'):
+def findDup(parentFolder, listOfPaths=None, mode='binary', prefilter=False, n_jobs=8, blocksize=1048576,
+            edgesize=65536, use_mmap=False, alg='sha256', cache=None):
     '''
     Dups in format {hash:[names]}
     
@@ -320,35 +709,85 @@ def findDup(parentFolder, listOfPaths=None, mode='binary'):
     pass the list to the second argument. Second one overrides first one.
     
     mode: can be binary or text
-
+    
+    By default every file is hashed in full and every file is returned, duplicate or not.
+    prefilter: if True a staged pipeline is used, for when only the duplicates are wanted -
+        1) files are grouped by size; a file with a unique size cannot have a duplicate and is never read
+        2) same size files larger than 2*edgesize are grouped by the hash of their first and last edgesize bytes
+        3) only the remaining candidates are hashed in full
+    The keys are still the full file hashes, but only groups of 2 or more duplicates are returned: files
+    without a duplicate are left out, as most of them are never read.
+    
+    n_jobs: number of threads used for hashing (hashlib releases the GIL, so threads scale on fast disks)
+    blocksize, use_mmap: passed to hashfile for the full hashes
+    
+    cache: a HashCache or the filename of one. Unchanged files are answered from the cache, so a
+    repeat scan over a mostly unchanged folder costs little more than listing and stat-ing it.
+    Entries of files that have disappeared from parentFolder are evicted at the end of the scan.
     ''' 
     
-    dups = {}
+    owncache = False
+    if cache is not None and not isinstance(cache, HashCache):
+        cache = HashCache(cache)
+        owncache = True
     
+    paths = []
     if listOfPaths is None:
         for dirName, subdirs, fileList in os.walk(parentFolder):
             print('Scanning %s...' % dirName)
             for filename in fileList:
                 # Get the path to the file
-                path = os.path.join(dirName, filename)
-                # Calculate hash
-                file_hash = hashfile(path)
-                # Add or append the file path
-                if file_hash in dups:
-                    dups[file_hash].append(path)
-                else:
-                    dups[file_hash] = [path]
+                paths.append(os.path.join(dirName, filename))
     else:
-        for path in listOfPaths:
-            # Calculate hash
-            file_hash = hashfile(path)
-            # Add or append the file path
-            if file_hash in dups:
-                dups[file_hash].append(path)
+        paths = list(listOfPaths)
+    
+    fullhash = lambda path: hashfile(path, blocksize=blocksize, mode=mode, alg=alg, use_mmap=use_mmap, cache=cache)
+    edgehash = lambda path: hashfile_edges(path, edgesize=edgesize, alg=alg, cache=cache)
+    
+    try:
+        return _findDup(paths, fullhash, edgehash, prefilter, n_jobs, edgesize)
+    finally:
+        if cache is not None:
+            if listOfPaths is None:
+                cache.prune(under=parentFolder)
+            if owncache:
+                cache.close()
             else:
-                dups[file_hash] = [path]
-            
-    return dups
+                cache.commit()
+
+
+def _findDup(paths, fullhash, edgehash, prefilter, n_jobs, edgesize):
+    with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+        if not prefilter:
+            return _group_paths(paths, pool.map(fullhash, paths))
+        
+        # Stage 1: sizes
+        sizes = [os.path.getsize(path) for path in paths]
+        by_size = _group_paths(paths, sizes)
+        
+        candidates = []
+        to_edge = []
+        for size, group in by_size.items():
+            if len(group) < 2:
+                continue
+            if size <= 2*edgesize:
+                candidates.extend(group) # edges would cover the whole file anyway
+            else:
+                to_edge.extend(group)
+        
+        # Stage 2: first and last blocks
+        to_edge_sizes = [os.path.getsize(path) for path in to_edge]
+        edge_keys = list(zip(to_edge_sizes, pool.map(edgehash, to_edge)))
+        for group in _group_paths(to_edge, edge_keys).values():
+            if len(group) > 1:
+                candidates.extend(group)
+        
+        # Stage 3: full hashes of the remaining candidates, in the original listing order
+        order = dict((path, i) for i, path in enumerate(paths))
+        candidates.sort(key=order.get)
+        dups = _group_paths(candidates, pool.map(fullhash, candidates))
+    
+    return dict((file_hash, group) for file_hash, group in dups.items() if len(group) > 1)
     
     
 def histogram_equalize_data(data_array, inverse_transform=False, bins=None, 
@@ -381,7 +820,10 @@ def histogram_equalize_data(data_array, inverse_transform=False, bins=None,
     + new_data_array : Transformed data array according to requirements
     + dfhist : dataframe is returned with data requried to map back - Needed if using inverse later.
     
+    
+    For large arrays or many columns use HistogramEqualizer instead, which keeps a fixed size lookup table.
     '''
+    data_array = np.asarray(data_array)
     if plot:
         plt.figure()
     if lossless or bins is None:
@@ -389,25 +831,27 @@ def histogram_equalize_data(data_array, inverse_transform=False, bins=None,
         if is_image_intensities:
             bins=255
         
-    mind = min(data_array)
-    maxd = max(data_array)
+    mind = np.min(data_array)
+    maxd = np.max(data_array)
     
     bins = np.linspace(mind, maxd, bins+2) # fixed number of bins
     
+    freq, bins = np.histogram(data_array, bins=bins)
     
-    plt.subplot(121)
-    plt.xlim([mind, maxd])
-    plot1 = plt.hist(data_array, bins=bins, alpha=0.5)
-    plt.title('Input Histogram')
-    plt.xlabel('Values')
-    plt.ylabel('count')
+    if plot:
+        plt.subplot(121)
+        plt.xlim([mind, maxd])
+        plt.hist(data_array, bins=bins, alpha=0.5)
+        plt.title('Input Histogram')
+        plt.xlabel('Values')
+        plt.ylabel('count')
     
     
     if not inverse_transform:
     
         dfhist = pd.DataFrame()
-        dfhist['inputbins'] = plot1[1][:-1]
-        dfhist['freq'] = plot1[0]
+        dfhist['inputbins'] = bins[:-1]
+        dfhist['freq'] = freq
         dfhist['freq_cumsum'] = dfhist['freq'].values.cumsum()
         dfhist['normalized_cumsum'] = dfhist['freq_cumsum']/float(len(data_array))
 
@@ -416,7 +860,7 @@ def histogram_equalize_data(data_array, inverse_transform=False, bins=None,
 
         # map the actual values back 
         bins = dfhist['inputbins'].values
-        newvaluesoutput = dfhist.loc[np.digitize(data_array, bins)-1]['remap_values'].values
+        newvaluesoutput = dfhist['remap_values'].values[np.digitize(data_array, bins)-1]
 
         if dont_touch_value is not None:
             newvaluesoutput[np.where(data_array == dont_touch_value)[0]]=dont_touch_value 
@@ -424,15 +868,13 @@ def histogram_equalize_data(data_array, inverse_transform=False, bins=None,
 
 
         
-        plt.subplot(122)
-        plt.xlim([mind, maxd])
-        plot1 = plt.hist(newvaluesoutput, bins=bins, alpha=0.5)
-        plt.title('Output Equalized Histogram')
-        plt.xlabel('Values')
-        plt.ylabel('count')
-
-
         if plot:
+            plt.subplot(122)
+            plt.xlim([mind, maxd])
+            plt.hist(newvaluesoutput, bins=bins, alpha=0.5)
+            plt.title('Output Equalized Histogram')
+            plt.xlabel('Values')
+            plt.ylabel('count')
             plt.tight_layout()
             plt.show()
 
@@ -447,22 +889,130 @@ def histogram_equalize_data(data_array, inverse_transform=False, bins=None,
         invbins = dfhist['remap_values'].values
         
         # for this case data_array is the equalized format
-        oldoutput = dfhist.loc[np.digitize(data_array, invbins)-1]['inputbins'].values
+        oldoutput = dfhist['inputbins'].values[np.digitize(data_array, invbins)-1]
         
-        plt.subplot(122)
-        plt.xlim([mind, maxd])
-        plot1 = plt.hist(oldoutput, bins=bins, alpha=0.5)
-        plt.title('Output Restored Histogram')
-        plt.xlabel('Values')
-        plt.ylabel('count')
-
-
         if plot:
+            plt.subplot(122)
+            plt.xlim([mind, maxd])
+            plt.hist(oldoutput, bins=bins, alpha=0.5)
+            plt.title('Output Restored Histogram')
+            plt.xlabel('Values')
+            plt.ylabel('count')
             plt.tight_layout()
             plt.show()
         
         
-        return oldoutput, dfhist.copy()  
+        return oldoutput, dfhist.copy()
+
+
+class HistogramEqualizer(object):
+    '''
+    Headless, fit/transform version of histogram_equalize_data for large data and many columns at once.
+    
+    Instead of one bin per value, each column's empirical CDF is stored as a fixed size lookup table of
+    n_quantiles quantiles, so memory does not grow with the data and transform/inverse_transform are a
+    np.interp per column. As in histogram_equalize_data, the equalized values are spread uniformly over
+    the column's original [min, max] range.
+    
+    + n_quantiles - size of the lookup table per column. Transform is lossless up to interpolation between
+    neighbouring quantiles; raise this for more resolution.
+    + subsample - if given, the quantiles are estimated from at most this many randomly chosen rows
+    + dont_touch_value - values equal to this are passed through unchanged. None to change everything.
+    
+    Usage:
+        eq = HistogramEqualizer(n_quantiles=10000).fit(train_x)   # train_x: 1D or (n_rows, n_cols)
+        train_eq = eq.transform(train_x)
+        test_eq = eq.transform(test_x)
+        restored = eq.inverse_transform(test_eq)
+        eq.plot(train_x)  # optional, before/after histograms of the first column
+    '''
+    
+    def __init__(self, n_quantiles=10000, subsample=None, dont_touch_value=0, seed=28081994):
+        self.n_quantiles = n_quantiles
+        self.subsample = subsample
+        self.dont_touch_value = dont_touch_value
+        self.seed = seed
+        self.quantiles_ = None
+        self.references_ = None
+        
+    @staticmethod
+    def _as2d(x):
+        x = np.asarray(x)
+        return x.reshape(-1, 1) if x.ndim == 1 else x
+    
+    def fit(self, x):
+        x = self._as2d(x)
+        if self.subsample is not None and x.shape[0] > self.subsample:
+            rows = np.random.RandomState(self.seed).choice(x.shape[0], self.subsample, replace=False)
+            x = x[np.sort(rows)]
+        n_quantiles = max(2, min(self.n_quantiles, x.shape[0]))
+        self.references_ = np.linspace(0, 1, n_quantiles)
+        self.quantiles_ = np.empty((n_quantiles, x.shape[1]), dtype=np.float64)
+        for col in range(x.shape[1]):
+            self.quantiles_[:, col] = np.quantile(x[:, col], self.references_)
+        # ties make the table flat; keep it monotonic for interp
+        self.quantiles_ = np.maximum.accumulate(self.quantiles_, axis=0)
+        return self
+    
+    def _cdf(self, values, col):
+        q = self.quantiles_[:, col]
+        r = self.references_
+        # average of forward and backward interpolation so that runs of tied quantiles map to their midpoint
+        return 0.5 * (np.interp(values, q, r) - np.interp(-values, -q[::-1], -r[::-1]))
+    
+    def _transform_col(self, values, col):
+        mind, maxd = self.quantiles_[0, col], self.quantiles_[-1, col]
+        newvalues = mind + self._cdf(values, col) * (maxd - mind)
+        if self.dont_touch_value is not None:
+            newvalues[values == self.dont_touch_value] = self.dont_touch_value
+        return newvalues
+    
+    def _inverse_col(self, values, col):
+        mind, maxd = self.quantiles_[0, col], self.quantiles_[-1, col]
+        span = (maxd - mind) if maxd > mind else 1.0
+        oldvalues = np.interp((values - mind) / span, self.references_, self.quantiles_[:, col])
+        if self.dont_touch_value is not None:
+            oldvalues[values == self.dont_touch_value] = self.dont_touch_value
+        return oldvalues
+    
+    def _apply(self, colfunc, x, out):
+        if self.quantiles_ is None:
+            raise ValueError('HistogramEqualizer is not fitted yet. Call fit first.')
+        x = np.asarray(x)
+        if out is None:
+            out = np.empty(x.shape, dtype=np.result_type(x.dtype, np.float32))
+        x2, out2 = self._as2d(x), self._as2d(out)
+        for col in range(x2.shape[1]):
+            out2[:, col] = colfunc(x2[:, col], col)
+        return out
+    
+    def transform(self, x, out=None):
+        '''Equalizes x (same number of columns as fit). out may be a preallocated array to write into.'''
+        return self._apply(self._transform_col, x, out)
+    
+    def inverse_transform(self, x, out=None):
+        return self._apply(self._inverse_col, x, out)
+    
+    def fit_transform(self, x, out=None):
+        return self.fit(x).transform(x, out=out)
+    
+    def plot(self, x, col=0, bins=100):
+        '''Input vs equalized histograms of one column. Kept out of fit/transform on purpose.'''
+        values = self._as2d(x)[:, col]
+        newvalues = self._transform_col(values, col)
+        plt.figure()
+        plt.subplot(121)
+        plt.hist(values, bins=bins, alpha=0.5)
+        plt.title('Input Histogram')
+        plt.xlabel('Values')
+        plt.ylabel('count')
+        plt.subplot(122)
+        plt.hist(newvalues, bins=bins, alpha=0.5)
+        plt.title('Output Equalized Histogram')
+        plt.xlabel('Values')
+        plt.ylabel('count')
+        plt.tight_layout()
+        plt.show()
     
     
 def RankAverager(valpreds, testpreds, predcol='pred', scale_test_proba=False):
@@ -477,6 +1027,9 @@ def RankAverager(valpreds, testpreds, predcol='pred', scale_test_proba=False):
     other model later.
     
     Very efficient implementation! Uses Binary Search.
+    
+    Note: adds the rank columns to valpreds/testpreds in place. For many columns or large test sets
+    in batches, use RankMapper.
     '''
     print('Val: ', valpreds.shape)
     print('Test: ',testpreds.shape)
@@ -506,6 +1059,161 @@ def RankAverager(valpreds, testpreds, predcol='pred', scale_test_proba=False):
     
     return testpreds.copy() 
     
+class RankMapper(object):
+    '''
+    Streaming, multi-column version of RankAverager.
+    
+    fit sorts each validation prediction column once and keeps only the sorted arrays. transform then maps
+    any chunk of test predictions for all columns at once with np.searchsorted - the input is neither
+    copied nor modified, and the result can be written into a preallocated output (eg. a memmap).
+    
+    The ranks are identical to RankAverager's 'rankavg_<predcol>' and the probas to
+    'rankavg_<predcol>_proba' with scale_test_proba=False (the min-max scaling needs the full test set,
+    apply it afterwards if needed).
+    
+    Usage:
+        rm = RankMapper().fit(valdf, predcols=['pred_lgb', 'pred_xgb'])
+        out = np.empty((len(testdf), 2), dtype=np.float32)
+        for start in range(0, len(testdf), 1000000):
+            chunk = testdf[['pred_lgb', 'pred_xgb']].values[start:start+1000000]
+            rm.transform(chunk, out=out[start:start+1000000])
+    '''
+    
+    def __init__(self, proba=True):
+        self.proba = proba
+        self.sorted_ = None
+        self.predcols = None
+        
+    def fit(self, valpreds, predcols=None):
+        '''valpreds: DataFrame (predcols selects the columns, default all) or 1D/2D numpy array.'''
+        if isinstance(valpreds, pd.DataFrame):
+            self.predcols = list(valpreds.columns) if predcols is None else list(predcols)
+            valpreds = valpreds[self.predcols].values
+        valpreds = np.asarray(valpreds)
+        if valpreds.ndim == 1:
+            valpreds = valpreds[:, None]
+        self.sorted_ = np.sort(valpreds, axis=0)
+        return self
+    
+    def transform(self, testpreds, out=None):
+        '''
+        testpreds: DataFrame with the fitted predcols, or numpy array with the same columns in the same order.
+        Returns ranks (proba=False) or ranks/(n_val+1) (proba=True), shape (n_rows, n_cols).
+        '''
+        if self.sorted_ is None:
+            raise ValueError('RankMapper is not fitted yet. Call fit first.')
+        if isinstance(testpreds, pd.DataFrame):
+            testpreds = testpreds[self.predcols].values if self.predcols is not None else testpreds.values
+        testpreds = np.asarray(testpreds)
+        if testpreds.ndim == 1:
+            testpreds = testpreds[:, None]
+        if out is None:
+            out = np.empty(testpreds.shape, dtype=np.float64 if self.proba else np.int64)
+        out2 = out.reshape(-1, 1) if out.ndim == 1 else out
+        
+        scale = 1.0 / float(self.sorted_.shape[0] + 1)
+        for col in range(self.sorted_.shape[1]):
+            ranks = np.searchsorted(self.sorted_[:, col], testpreds[:, col]) + 1
+            if self.proba:
+                out2[:, col] = ranks * scale
+            else:
+                out2[:, col] = ranks
+        return out
+    
+    
+def stacked_preds_averager(preds, weights=None, type='AM', convert_to_ranks=False, normalize=True,
+                           chunk_rows=None, max_bytes=2**28, out=None, ranks_out=None):
+    '''
+    Vectorized preds_averager over one stacked prediction tensor.
+    
+    preds: array (or np.memmap) of shape (n_models, n_rows, n_classes) or (n_models, n_rows), preferably float32,
+    or a list of n_models arrays of shape (n_rows, n_classes) or (n_rows,), which is used as is (not stacked).
+    Rows are processed chunk_rows at a time, and each mean is a weighted reduction (np.tensordot) over the model
+    axis of a float64 block of the chunk, as many models per block as max_bytes allows (usually all of them):
+    
+    AM - sum(w*p)/sum(w)
+    GM - exp(sum(w*log(p))) with w normalized to sum 1, ie. in log space so many models do not underflow
+    HM - sum(w)*n_models/sum(w/p), the same scaling as preds_averager
+    
+    max_bytes: working memory of the float64 block and sums, whatever n_models. chunk_rows, if not given, is
+    chosen so that all the models of a chunk fit in one block, unless that leaves chunks under 4096 rows.
+    
+    convert_to_ranks: as in preds_averager, each model's columns are replaced by rank/n_rows (ties averaged)
+    and row normalized when there is more than one class. This needs the full columns, so a float32 rank
+    tensor of the size of preds is built first: in ranks_out if given (eg. a memmap of shape
+    (n_models,) + preds.shape[1:]), else in memory.
+    
+    normalize: row normalize the output when there is more than one class.
+    out: optional preallocated output of shape preds.shape[1:] (eg. a memmap).
+    '''
+    if type not in ('AM', 'GM', 'HM'):
+        raise ValueError('type should be one of AM, GM or HM.')
+    n_models = len(preds)
+    shape = np.shape(preds[0])
+    if isinstance(preds, np.ndarray):
+        dtype = preds.dtype
+    else:
+        dtype = np.result_type(*[getattr(p, 'dtype', np.float64) for p in preds])
+    if weights is None:
+        weights = np.ones((n_models,), dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    
+    if convert_to_ranks:
+        ranks = ranks_out if ranks_out is not None else np.empty((n_models,) + shape, dtype=np.float32)
+        for i in range(n_models):
+            rank = scipy_stats.rankdata(preds[i], axis=0) / float(shape[0])
+            if normalize and rank.ndim == 2 and rank.shape[1] > 1:
+                rank /= rank.sum(axis=1, keepdims=True)
+            ranks[i] = rank
+        preds = ranks
+        dtype = ranks.dtype
+    
+    if out is None:
+        out = np.empty(shape, dtype=np.result_type(dtype, np.float32))
+    row_bytes = 8 * int(np.prod(shape[1:]))
+    if chunk_rows is None:
+        # the float64 block of models + the sum and the tensordot result of the chunk
+        chunk_rows = max(max_bytes // (row_bytes * (n_models + 2)), min(4096, max_bytes // (row_bytes * 3)))
+    chunk_rows = int(max(1, min(chunk_rows, shape[0])))
+    block_models = int(max(1, min(n_models, max_bytes // (row_bytes * chunk_rows) - 2)))
+    
+    if type == 'GM':
+        weights = weights / np.sum(weights)
+    
+    block_buf = np.empty(block_models * chunk_rows * (row_bytes // 8), dtype=np.float64)
+    for start in range(0, shape[0], chunk_rows):
+        stop = min(start + chunk_rows, shape[0])
+        acc = None
+        for m0 in range(0, n_models, block_models):
+            m1 = min(m0 + block_models, n_models)
+            # contiguous, so tensordot does not copy it
+            block = block_buf[:(m1-m0) * (stop-start) * (row_bytes // 8)].reshape((m1-m0, stop-start) + shape[1:])
+            if isinstance(preds, np.ndarray):
+                block[...] = preds[m0:m1, start:stop]
+            else:
+                for k in range(m0, m1):
+                    block[k-m0] = preds[k][start:stop]
+            if type == 'GM':
+                np.log(block, out=block)
+            elif type == 'HM':
+                np.reciprocal(block, out=block)
+            part = np.tensordot(weights[m0:m1], block, axes=1)
+            acc = part if acc is None else acc + part
+        
+        if type == 'AM':
+            acc /= np.sum(weights)
+        elif type == 'GM':
+            np.exp(acc, out=acc)
+        else:
+            acc = (np.sum(weights) * float(n_models)) / acc
+        
+        if normalize and acc.ndim == 2 and acc.shape[1] > 1: # as if = 1 then all preds will be 1!
+            acc /= acc.sum(axis=1, keepdims=True)
+        out[start:stop] = acc
+        
+    return out
+
+
 def preds_averager(preds, weights=None, type='AM', convert_to_ranks=False, normalize=True):
     '''
     preds is a list of predictions from predictors(numpy) taken directly from 
@@ -521,70 +1229,68 @@ def preds_averager(preds, weights=None, type='AM', convert_to_ranks=False, norma
     top Public LB (Private not guaranteed!).
     
     Normalization of preds is done.
+    
+    The list is combined by stacked_preds_averager, model by model, without stacking a copy of it. For hundreds
+    of models over millions of rows, build the (n_models, n_rows, n_classes) float32 memmap yourself and call
+    that directly.
     '''
-   
-    if weights is None:
-        weights = np.ones((len(preds),), dtype=np.float)
-        
-    if convert_to_ranks:
-        preds_new = []
-        for i in preds:
-            df = pd.DataFrame(i)
-            df = df.rank()/ df.shape[0]
-            
-            if normalize:
-                if df.shape[1]>1: # if more than one prediction column
-                    df = normalizedf(df)
-            
-            preds_new.append(df.values)
-        
-        preds = preds_new
     
-    if len(preds) == 1:
-        return preds[0]
-    elif len(preds) == 0:
+    if len(preds) == 0:
         return None
     
-    ans = []
-    if type=='AM':
-        ans = preds[0]*weights[0]
-        counter = 1
-        for i in preds[1:]:
-            ans = ans + i*weights[counter]
-            counter += 1
-        
-        ans = ans/float(sum(weights))
-        
-    if type=='GM':
-        weights = np.array(weights)
-        weights = weights / np.sum(weights)
-        
-        ans = preds[0]**weights[0]
-        counter = 1
-        for i in preds[1:]:
-            ans = ans*(i**weights[counter])
-            counter +=1
-        
-        
-    if type== 'HM': 
-        
-        invans = float(weights[0])/preds[0]
-        counter = 1
-        for i in preds[1:]:
-            invans = invans + float(weights[counter])/i
-            counter+=1
-        ans = (float(sum(weights))*float(len(preds)))/invans
+    # 1D predictions come back as a single column, as before
+    columns = [p[:, None] if p.ndim == 1 else p for p in (np.asarray(i) for i in preds)]
+    out = np.empty(columns[0].shape, dtype=np.float64)
     
-    ans = pd.DataFrame(ans)
-    if normalize:
-        if ans.shape[1]>1: # as if = 1 then all preds will be 1!
-            ans = normalizedf(ans)
-    ans = ans.values
-    return ans
+    if len(preds) == 1:
+        if not convert_to_ranks:
+            return preds[0]
+        return stacked_preds_averager(columns, convert_to_ranks=True, normalize=normalize, out=out)
+    
+    return stacked_preds_averager(columns, weights=weights, type=type, convert_to_ranks=convert_to_ranks,
+                                  normalize=normalize, out=out)
+    
+    
+def _auc_columns(scores, y):
+    return xmetrics.auc_columns(y, scores)
+
+
+def _gini_columns(scores, y):
+    return 2.0 * xmetrics.auc_columns(y, scores) - 1.0
+
+
+def _logloss_columns(scores, y, eps=1e-15):
+    return xmetrics.logloss_columns(y, scores, eps)
+
+
+def _metric_columns(blends, y, metric_name):
+    if metric_name == 'auc':
+        return _auc_columns(blends, y)
+    elif metric_name == 'gini':
+        return _gini_columns(blends, y)
+    elif metric_name == 'logloss':
+        return _logloss_columns(blends, y)
+    raise ValueError('No vectorized kernel for metric '+str(metric_name))
+
+
+def _blend_scores(P, y, W, metric_name):
+    '''Scores the blends P.dot(w) of the (n_rows, n_models) predictions P for every weight row w of W.'''
+    return _metric_columns(P.dot(W.T), y, metric_name)
+
+
+_blend_pool_state = {}
+
+def _blend_pool_init(P, y):
+    _blend_pool_state['P'] = P
+    _blend_pool_state['y'] = y
+
+def _blend_pool_scores(W, metric_name):
+    return _blend_scores(_blend_pool_state['P'], _blend_pool_state['y'], W, metric_name)
     
     
 def desperateFitter(dflist, predcols=['pred'], gtcol='target', thrustMode=False, niters=1000, 
-                    metric=['logloss','gini','auc'], is_more_better=True, coarseness=10, custom_weight_functions=[np.exp]):
+                    metric=['logloss','gini','auc'], is_more_better=True, coarseness=10, custom_weight_functions=[np.exp],
+                    batch_size=32, n_jobs=1):
     '''
     DesperateFitter v1.12 - If you are desperate enough to not try a regression model!
     Iterates through Random weights that sum up to 1 and maximize a 
@@ -601,6 +1307,13 @@ def desperateFitter(dflist, predcols=['pred'], gtcol='target', thrustMode=False,
     thrustMode: When true, takes models pairwise and calculates weights successively greedily starting by
     fitting the best models and then the lesser good models. 
     
+    For large pools of models use caruanaFitter instead.
+    
+    batch_size, n_jobs: in the random search (single predcol and last metric auc, logloss or gini), the
+    predictions are stacked into one matrix and batch_size weight vectors are scored per matrix multiply
+    with vectorized metrics, the blocks spread over n_jobs processes. Results are the same as scoring
+    the weights one by one.
+    
     # TODO:
     # Add HM, GM based weights desperateFitter
     
@@ -629,20 +1342,20 @@ def desperateFitter(dflist, predcols=['pred'], gtcol='target', thrustMode=False,
             metric_label = None
             if i == 'auc':
                 metric_label='auc'
-                i=roc_auc_score
+                i=xmetrics.auc if len(predcols)==1 else sk_metrics.roc_auc_score
             elif i=='logloss':
                 metric_label='ll'
-                i=log_loss
+                i=xmetrics.logloss if len(predcols)==1 else sk_metrics.log_loss
             elif i=='gini':
                 metric_label='gini'
-                i=eval_gini
+                i=xmetrics.gini
             else:
                 metric_label='metric'+str(counter)
                 
             if len(predcols)==1:
-                metric_result = i(newdf['target'], newdf[predcols[0]])   
+                metric_result = i(newdf[gtcol], newdf[predcols[0]])   
             else:
-                metric_result = i(newdf['target'], newdf[predcols])    
+                metric_result = i(newdf[gtcol], newdf[predcols])    
             metric_results.append(metric_result)
             metric_labels.append(metric_label)
             
@@ -746,33 +1459,72 @@ def desperateFitter(dflist, predcols=['pred'], gtcol='target', thrustMode=False,
     
     if not thrustMode:
         
+        # draw all the random weights up front (same sequence as drawing them one at a time)
+        allweights = []
         for iters in range(niters):
             randnums = []
             for x in range(nummodels):
                 randnums.append(random.randint(1, int(coarseness)))
             randnums = np.array(randnums)
 
-            randweights = randnums/np.sum(randnums)
+            allweights.append(randnums/np.sum(randnums))
+        
+        def tryWeights(randweights):
             metric_labels, metric_results = calcMetrics(dflist, randweights, silent=True)
             
             if is_more_better:
-                if metric_results[-1] > best_metric:
-                    best_metric = metric_results[-1]
-                    best_weights = randweights
-                    
-                    print(randweights, end='  ')
-                    for i in range(len(metric_labels)):
-                        print(metric_labels[i], ':', metric_results[i], '\t', end='')
-                    print('\n')
+                improved = metric_results[-1] > best_metric
             else:
-                if metric_results[-1] < best_metric:
-                    best_metric = metric_results[-1]
-                    best_weights = randweights
-                    
-                    print(randweights, end='  ')
-                    for i in range(len(metric_labels)):
-                        print(metric_labels[i], ':', metric_results[i], '\t', end='')
-                    print('\n')
+                improved = metric_results[-1] < best_metric
+            
+            if improved:
+                print(randweights, end='  ')
+                for i in range(len(metric_labels)):
+                    print(metric_labels[i], ':', metric_results[i], '\t', end='')
+                print('\n')
+            return improved, metric_results[-1]
+        
+        fast_metric = None
+        if len(predcols) == 1 and metric[-1] in ('auc', 'logloss', 'gini'):
+            fast_metric = metric[-1]
+        
+        if fast_metric is None:
+            for randweights in allweights:
+                improved, result = tryWeights(randweights)
+                if improved:
+                    best_metric, best_weights = result, randweights
+        else:
+            # Score whole blocks of weight vectors at once with one matrix multiply and vectorized metrics.
+            # Candidates that may beat the best are confirmed with calcMetrics, so the picks and the printed
+            # metrics are those of the one-at-a-time search.
+            P = np.column_stack([df[predcols[0]].values for df in dflist]).astype(np.float64)
+            y = np.asarray(dflist[0][gtcol].values)
+            blocks = [np.array(allweights[s:s+batch_size]) for s in range(0, niters, batch_size)]
+            
+            pool = None
+            if n_jobs > 1 and len(blocks) > 1:
+                pool = ProcessPoolExecutor(max_workers=n_jobs, initializer=_blend_pool_init, initargs=(P, y))
+                block_scores = pool.map(_blend_pool_scores, blocks, [fast_metric]*len(blocks))
+            else:
+                block_scores = (_blend_scores(P, y, W, fast_metric) for W in blocks)
+            
+            try:
+                counter = 0
+                for scores in block_scores:
+                    for score in scores:
+                        randweights = allweights[counter]
+                        counter += 1
+                        tol = 1e-9 * max(1.0, abs(best_metric))
+                        if is_more_better and score <= best_metric - tol:
+                            continue
+                        if not is_more_better and score >= best_metric + tol:
+                            continue
+                        improved, result = tryWeights(randweights)
+                        if improved:
+                            best_metric, best_weights = result, randweights
+            finally:
+                if pool is not None:
+                    pool.shutdown()
                         
     else: # thrust mode!
         
@@ -874,6 +1626,88 @@ def desperateFitter(dflist, predcols=['pred'], gtcol='target', thrustMode=False,
     return best_weights, metric_labels, metric_results
 
 
+def caruanaFitter(preds, y, metric='auc', n_steps=50, n_bags=20, bag_fraction=0.5, init_size=1,
+                  use_ranks=False, batch_size=64, seed=28081994, verbose=True):
+    '''
+    Greedy forward ensemble selection with replacement and bagging (Caruana et al., 2004) - for when the pool
+    has hundreds of models and desperateFitter's random/thrust search does not scale.
+    
+    preds: DataFrame of validation (OOF) predictions, one column per model - eg. getModelPoolPreds() of an
+    xGridSearch model pool - or a (n_rows, n_models) numpy array.
+    y: binary ground truth
+    metric: 'auc', 'gini' or 'logloss'
+    n_steps: models added per bag (with replacement, so a model can be picked several times)
+    n_bags, bag_fraction: each bag starts from a random bag_fraction of the pool; picks are summed over bags
+    init_size: each bag starts from its init_size best single models
+    use_ranks: blend rank/n_rows of each model (rank averaging) instead of the raw predictions.
+    The rank matrix is computed once up front.
+    
+    The running blend sum is kept, so adding a model is an O(n_rows) update and every step scores all
+    the candidates of the bag in one vectorized pass (batch_size candidates at a time).
+    
+    Returns: dict {model: weight} of the selected models (weights sum to 1), and the score of that blend.
+    '''
+    if isinstance(preds, pd.DataFrame):
+        names = list(preds.columns)
+        M = preds.values.astype(np.float64)
+    else:
+        M = np.asarray(preds, dtype=np.float64)
+        names = list(range(M.shape[1]))
+    y = np.asarray(y)
+    
+    if use_ranks:
+        M = scipy_stats.rankdata(M, axis=0) / float(M.shape[0])
+    
+    is_more_better = metric != 'logloss'
+    better = (lambda a, b: a > b) if is_more_better else (lambda a, b: a < b)
+    argbest = np.argmax if is_more_better else np.argmin
+    
+    def score_candidates(blend_sum, count, candidates):
+        scores = []
+        for s in range(0, len(candidates), batch_size):
+            cols = candidates[s:s+batch_size]
+            blends = (blend_sum[:, None] + M[:, cols]) / float(count + 1)
+            scores.append(_metric_columns(blends, y, metric))
+        return np.concatenate(scores)
+    
+    rng = np.random.RandomState(seed)
+    n_models = M.shape[1]
+    bag_size = max(1, int(round(bag_fraction * n_models)))
+    counts = np.zeros(n_models, dtype=np.int64)
+    
+    for bag in range(n_bags):
+        candidates = np.sort(rng.choice(n_models, bag_size, replace=False)) if n_bags > 1 else np.arange(n_models)
+        
+        singles = score_candidates(np.zeros(M.shape[0]), 0, candidates)
+        order = np.argsort(-singles if is_more_better else singles, kind='mergesort')
+        picks = list(candidates[order[:init_size]])
+        blend_sum = M[:, picks].sum(axis=1)
+        
+        best_score = _metric_columns((blend_sum / float(len(picks)))[:, None], y, metric)[0] # the initial picks alone
+        best_len = len(picks)
+        for step in range(n_steps):
+            scores = score_candidates(blend_sum, len(picks), candidates)
+            i = argbest(scores)
+            picks.append(candidates[i])
+            blend_sum += M[:, candidates[i]]
+            if better(scores[i], best_score):
+                best_score = scores[i]
+                best_len = len(picks)
+        
+        for pick in picks[:best_len]:
+            counts[pick] += 1
+        if verbose:
+            print('Bag', bag+1, 'of', n_bags, '- models picked:', best_len, metric, ':', best_score)
+    
+    weights = counts / float(counts.sum())
+    selected = dict((names[i], weights[i]) for i in np.nonzero(counts)[0])
+    final_score = _blend_scores(M, y, weights[None, :], metric)[0]
+    
+    if verbose:
+        print('\nSelected', len(selected), 'of', n_models, 'models. Ensemble', metric, ':', final_score)
+    return selected, final_score
+    
+    
 def gaussian_feature_importances(df, missing_value=-1, skip_columns=['id','target']):
     '''
     If missing_value is provided then fields having -1 are neglected while generating feature importances.
@@ -987,60 +1821,558 @@ def create_pairwise_feature_interactions(df, custom_ops=[], columns=None, type='
         return newdf
 
 # easy pickles
-def get(name):
-    f=open(name, 'rb')
+_PICKLE_MAGIC = b'XTPICKL5'
+
+
+class LazyDict(Mapping):
+    '''Read-only dict returned by get(name, lazy=True). Each value is unpickled on first access.'''
+    
+    def __init__(self, keys, loader):
+        self._keys = keys
+        self._index = dict((key, i) for i, key in enumerate(keys))
+        self._loader = loader
+        self._loaded = {}
+        
+    def __getitem__(self, key):
+        if key not in self._loaded:
+            self._loaded[key] = self._loader(self._index[key])
+        return self._loaded[key]
+    
+    def __iter__(self):
+        return iter(self._keys)
+    
+    def __len__(self):
+        return len(self._keys)
+
+
+def _write_record(f, obj, compression, level):
+    buffers = []
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    record = {'buffers': []}
+    for buf in buffers:
+        raw = buf.raw()
+        f.write(b'\0' * (-f.tell() % 64)) # keep the arrays aligned for zero copy loads
+        offset = f.tell()
+        f.write(_compress(raw, compression, level))
+        record['buffers'].append((offset, f.tell() - offset))
+    offset = f.tell()
+    f.write(_compress(data, compression, level))
+    record['pickle'] = (offset, f.tell() - offset)
+    return record
+
+
+def _read_record(view, record, compression, mmap_mode):
+    buffers = []
+    for offset, length in record['buffers']:
+        buf = view[offset:offset+length]
+        if compression is not None:
+            buf = _decompress(buf, compression)
+            if mmap_mode != 'r':
+                buf = bytearray(buf) # writable arrays, like a plain unpickle
+        buffers.append(buf)
+    offset, length = record['pickle']
+    return pickle.loads(_decompress(view[offset:offset+length], compression), buffers=buffers)
+
+
+def get(name, lazy=False, mmap_mode='c'):
+    '''
+    Loads an object saved by put (or any plain pickle, including python 2 ones).
+    
+    Files written by put are memory mapped and the numpy buffers inside them (arrays, DataFrame blocks)
+    are used in place, without copies:
+    mmap_mode='c' - copy on write: arrays are writable, changes stay in memory (default)
+    mmap_mode='r' - read only arrays
+    mmap_mode=None - read the buffers into memory
+    Compressed files are always decompressed into memory.
+    
+    lazy: if the saved object is a dict, return a LazyDict that unpickles each value on first access,
+    eg. to get one member of a big results dict without loading the rest.
+    '''
+    with open(name, 'rb') as f:
+        head = f.read(len(_PICKLE_MAGIC))
+        if head != _PICKLE_MAGIC:
+            f.seek(0)
+            # protocol <= 2 pickles may come from python 2, whose str need latin1 to load numpy arrays
+            legacy = head[:1] != b'\x80' or head[1:2] in (b'\x01', b'\x02')
+            if legacy:
+                return pickle.load(f, encoding='latin1')
+            return pickle.load(f)
+        
+        if mmap_mode is None:
+            view = memoryview(_read_all(f))
+        else:
+            access = mmap.ACCESS_COPY if mmap_mode == 'c' else mmap.ACCESS_READ
+            view = memoryview(mmap.mmap(f.fileno(), 0, access=access))
+    
+    header_offset = int(np.frombuffer(view[-16:-8], dtype='<u8')[0])
+    header = pickle.loads(view[header_offset:-16])
+    compression = header['compression']
+    load = lambda i: _read_record(view, header['records'][i], compression, mmap_mode)
+    
+    if header['keys'] is None:
+        return load(0)
+    if lazy:
+        return LazyDict(header['keys'], load)
+    return dict((key, load(i)) for i, key in enumerate(header['keys']))
+
+
+def _read_all(f):
+    f.seek(0, os.SEEK_END)
+    buf = bytearray(f.tell())
+    f.seek(0)
+    f.readinto(buf)
+    return buf
+
+
+def put(path, obj, compression=None, level=1):
+    '''
+    Saves obj with pickle protocol 5. numpy buffers (arrays, DataFrame blocks) are written out of band,
+    aligned, so get can memory map them back without copies. A plain dict is saved member by member, so
+    get(path, lazy=True) can load single members; objects shared between members come back as separate
+    copies. dict subclasses (OrderedDict, defaultdict, ...) and everything else are pickled whole.
+    
+    compression: None, 'zlib' or 'blosc' (fast, optional dependency) - applied per buffer
+    
+    The file is written to a temporary file next to path and renamed over it, so a crash never leaves
+    a half written file behind.
+    '''
+    tmp = '%s.tmp%d' % (path, os.getpid())
     try:
-        mod = pickle.load(f)
+        with open(tmp, 'wb') as f:
+            f.write(_PICKLE_MAGIC)
+            if type(obj) is dict:
+                keys = list(obj.keys())
+                records = [_write_record(f, obj[key], compression, level) for key in keys]
+            else:
+                keys = None
+                records = [_write_record(f, obj, compression, level)]
+            header_offset = f.tell()
+            f.write(pickle.dumps({'version': 1, 'compression': compression, 'keys': keys, 'records': records},
+                                 protocol=4))
+            f.write(np.array([header_offset], dtype='<u8').tobytes())
+            f.write(_PICKLE_MAGIC)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
     except:
-        mod = pickle.load(f, encoding='latin1') # to resolve python 2 vs 3 incompatibility of pickles
-    f.close()
-    return mod
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return True
+
+def _compress(buf, compression, level):
+    if compression is None:
+        return buf
+    elif compression == 'zlib':
+        return zlib.compress(buf, level)
+    elif compression == 'blosc':
+        import blosc # optional, much faster than zlib
+        return blosc.compress(buf, clevel=level)
+    raise ValueError('compression should be None, zlib or blosc.')
+
+
+def _decompress(buf, compression):
+    if compression is None:
+        return buf
+    elif compression == 'zlib':
+        return zlib.decompress(buf)
+    elif compression == 'blosc':
+        import blosc
+        return blosc.decompress(buf)
+    raise ValueError('compression should be None, zlib or blosc.')
+
+
+class ChunkedArray(object):
+    '''
+    Chunked, compressed on-disk array - the replacement of the bcolz carrays of save_array/load_array.
+    
+    Layout: rootdir/header.json (dtype, shape, chunk_rows, compression) and one file per chunk_rows rows,
+    rootdir/chunk_<k>.bin. Only the chunks touched by an index are read and decompressed (in parallel,
+    n_jobs threads - zlib and blosc release the GIL), so a CV fold or a prediction batch reads only what
+    it needs. With compression=None chunks are memory mapped instead of read.
+    
+    mode: 'r' read only, 'w' create (overwrites), 'a' append to existing (or create)
+    
+    Indexing: ca[i], ca[start:stop:step], ca[index_array], ca[bool_mask], and tuples thereof where the first
+    element selects rows, eg. ca[train_idx, :10]. np.asarray(ca) or ca[:] loads everything.
+    
+    Usage:
+        with ChunkedArray('./feats.xca', mode='w', dtype=np.float32, row_shape=(128,)) as ca:
+            for batch in batches:
+                ca.append(batch)
+        ca = ChunkedArray('./feats.xca')
+        x_fold = ca[train_idx]
+    '''
+    
+    def __init__(self, rootdir, mode='r', dtype=None, row_shape=(), chunk_rows=65536, compression='zlib',
+                 level=1, n_jobs=4, cache_chunks=2):
+        self.rootdir = rootdir
+        self.mode = mode
+        self.n_jobs = n_jobs
+        self.cache_chunks = cache_chunks
+        self._cache = OrderedDict()
+        self._tail = None
+        
+        headerfile = os.path.join(rootdir, 'header.json')
+        if mode == 'w' or (mode == 'a' and not os.path.exists(headerfile)):
+            if dtype is None:
+                raise ValueError('dtype is needed to create a ChunkedArray.')
+            if np.dtype(dtype).hasobject:
+                raise ValueError('ChunkedArray cannot store object arrays. Use put() instead.')
+            if os.path.isdir(rootdir):
+                for f in os.listdir(rootdir):
+                    if f.startswith('chunk_') or f == 'header.json':
+                        os.remove(os.path.join(rootdir, f))
+            else:
+                os.makedirs(rootdir)
+            self.header = {'format': 'xtune-chunked', 'version': 1, 'dtype': np.dtype(dtype).str,
+                           'row_shape': list(row_shape), 'nrows': 0, 'chunk_rows': int(chunk_rows),
+                           'compression': compression, 'level': level}
+            self._write_header()
+        else:
+            with open(headerfile) as f:
+                self.header = json.load(f)
+        
+        self.dtype = np.dtype(self.header['dtype'])
+        self.row_shape = tuple(self.header['row_shape'])
+        self.chunk_rows = self.header['chunk_rows']
+        self.compression = self.header['compression']
+        
+        if mode == 'a' and self.header['nrows'] % self.chunk_rows:
+            # reopen the partial last chunk so that appends continue filling it
+            last = self.header['nrows'] // self.chunk_rows
+            self._tail = np.array(self._read_chunk(last))
+            self._cache.clear()
+            self.header['nrows'] -= len(self._tail)
+    
+    @property
+    def shape(self):
+        nrows = self.header['nrows'] + (0 if self._tail is None else len(self._tail))
+        return (nrows,) + self.row_shape
+    
+    @property
+    def ndim(self):
+        return 1 + len(self.row_shape)
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    @property
+    def nchunks(self):
+        return int(np.ceil(self.header['nrows'] / float(self.chunk_rows)))
+    
+    def _chunkfile(self, k):
+        return os.path.join(self.rootdir, 'chunk_%08d.bin' % k)
+    
+    def _write_header(self):
+        tmp = os.path.join(self.rootdir, 'header.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.header, f)
+        os.replace(tmp, os.path.join(self.rootdir, 'header.json'))
+    
+    def _write_chunk(self, k, rows):
+        tmp = self._chunkfile(k) + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_compress(np.ascontiguousarray(rows, dtype=self.dtype).tobytes(), self.compression,
+                              self.header['level']))
+        os.replace(tmp, self._chunkfile(k))
+        self._cache.pop(k, None)
+    
+    def _load_chunk(self, k):
+        nrows = min(self.chunk_rows, self.header['nrows'] - k * self.chunk_rows)
+        if self.compression is None:
+            return np.memmap(self._chunkfile(k), dtype=self.dtype, mode='r', shape=(nrows,) + self.row_shape)
+        with open(self._chunkfile(k), 'rb') as f:
+            buf = _decompress(f.read(), self.compression)
+        return np.frombuffer(buf, dtype=self.dtype).reshape((nrows,) + self.row_shape)
+    
+    def _cached_chunk(self, k):
+        if self._tail is not None and len(self._tail) and k == self.header['nrows'] // self.chunk_rows:
+            return self._tail # rows appended but not flushed yet
+        if k in self._cache:
+            self._cache.move_to_end(k)
+            return self._cache[k]
+        return None
+    
+    def _read_chunks(self, ks):
+        chunks = [self._cached_chunk(k) for k in ks]
+        missing = [k for k, chunk in zip(ks, chunks) if chunk is None]
+        if len(missing) > 1 and self.n_jobs > 1:
+            with ThreadPoolExecutor(max_workers=self.n_jobs) as pool:
+                loaded = dict(zip(missing, pool.map(self._load_chunk, missing)))
+        else:
+            loaded = dict((k, self._load_chunk(k)) for k in missing)
+        if self.cache_chunks:
+            for k in missing[-self.cache_chunks:]:
+                self._cache[k] = loaded[k]
+            while len(self._cache) > self.cache_chunks:
+                self._cache.popitem(last=False)
+        return [loaded[k] if chunk is None else chunk for k, chunk in zip(ks, chunks)]
+    
+    def _read_chunk(self, k):
+        return self._read_chunks([k])[0]
+    
+    def append(self, arr):
+        '''Appends rows (shape (n,) + row_shape). Full chunks are written right away, the rest on flush().'''
+        if self.mode == 'r':
+            raise IOError('ChunkedArray opened read only.')
+        arr = np.asarray(arr, dtype=self.dtype).reshape((-1,) + self.row_shape)
+        if self._tail is not None and len(self._tail):
+            arr = np.concatenate([self._tail, arr])
+        nfull = (len(arr) // self.chunk_rows) * self.chunk_rows
+        k0 = self.header['nrows'] // self.chunk_rows
+        for i, start in enumerate(range(0, nfull, self.chunk_rows)):
+            self._write_chunk(k0 + i, arr[start:start+self.chunk_rows])
+        self.header['nrows'] += nfull
+        self._tail = np.array(arr[nfull:])
+        return self
+    
+    def flush(self):
+        '''Writes the partial last chunk and the header. Further appends keep filling that chunk.'''
+        if self.mode == 'r':
+            return
+        if self._tail is not None and len(self._tail):
+            self._write_chunk(self.header['nrows'] // self.chunk_rows, self._tail)
+            self.header['nrows'] += len(self._tail)
+            self._write_header()
+            self.header['nrows'] -= len(self._tail)
+        else:
+            self._write_header()
+    
+    def close(self):
+        self.flush()
+        if self._tail is not None:
+            self.header['nrows'] += len(self._tail)
+            self._tail = None
+        self.mode = 'r'
+        self._cache.clear()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def __array__(self, dtype=None, copy=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
+    
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        nrows = len(self)
+        
+        if isinstance(key, (int, np.integer)):
+            i = key + nrows if key < 0 else key
+            if i < 0 or i >= nrows:
+                raise IndexError('index %d out of range for %d rows' % (key, nrows))
+            out = self._read_chunk(i // self.chunk_rows)[i % self.chunk_rows]
+            return np.array(out[rest] if rest else out)
+        
+        if isinstance(key, slice):
+            start, stop, step = key.indices(nrows)
+            if step == 1:
+                out = self._read_range(start, max(start, stop))
+            else:
+                out = self._read_rows(np.arange(start, stop, step))
+        else:
+            idx = np.asarray(key)
+            if idx.dtype == bool:
+                idx = np.nonzero(idx)[0]
+            idx = np.where(idx < 0, idx + nrows, idx).astype(np.int64)
+            out = self._read_rows(idx)
+        return out[(slice(None),) + rest] if rest else out
+    
+    def _read_range(self, start, stop):
+        out = np.empty((stop - start,) + self.row_shape, dtype=self.dtype)
+        if stop == start:
+            return out
+        ks = list(range(start // self.chunk_rows, (stop - 1) // self.chunk_rows + 1))
+        for k, chunk in zip(ks, self._read_chunks(ks)):
+            c0 = k * self.chunk_rows
+            lo, hi = max(start, c0), min(stop, c0 + len(chunk))
+            out[lo-start:hi-start] = chunk[lo-c0:hi-c0]
+        return out
+    
+    def _read_rows(self, idx):
+        out = np.empty((len(idx),) + self.row_shape, dtype=self.dtype)
+        if len(idx) == 0:
+            return out
+        if idx.max() >= len(self) or idx.min() < 0:
+            raise IndexError('row index out of range for %d rows' % len(self))
+        chunk_ids = idx // self.chunk_rows
+        # group the positions by chunk once: sorted indices (CV folds) already are, others get a stable argsort
+        order = None
+        if len(idx) > 1 and (np.diff(idx) < 0).any():
+            keys = chunk_ids.astype(np.uint16) if len(self) <= self.chunk_rows * 65536 else chunk_ids
+            order = np.argsort(keys, kind='stable') # radix sort on uint16
+            chunk_ids = chunk_ids[order]
+        starts = np.flatnonzero(np.r_[True, chunk_ids[1:] != chunk_ids[:-1]])
+        ends = np.r_[starts[1:], len(idx)]
+        ks = chunk_ids[starts].tolist()
+        for k, b0, b1, chunk in zip(ks, starts, ends, self._read_chunks(ks)):
+            c0 = k * self.chunk_rows
+            if order is not None:
+                pos = order[b0:b1]
+                out[pos] = chunk[idx[pos] - c0]
+            elif idx[b1-1] - idx[b0] == b1 - 1 - b0 and (np.diff(idx[b0:b1]) == 1).all(): # consecutive, no repeats
+                out[b0:b1] = chunk[idx[b0]-c0:idx[b1-1]-c0+1]
+            else:
+                np.take(chunk, idx[b0:b1] - c0, axis=0, out=out[b0:b1], mode='clip') # in range, no temporary
+        return out
 
-def put(path, obj):
-   f=open(path, 'wb')
-   pickle.dump(obj, f)
-   f.close()
-   return True
 
 # saving huge arrays without loss of precision or disk size constraint
-def save_array(fname, arr):
-    c=bcolz.carray(arr, rootdir=fname, mode='w')
-    c.flush()
+def save_array(fname, arr, chunk_rows=65536, compression='zlib', level=1):
+    '''Writes arr as a ChunkedArray directory. Read it back with load_array, or lazily with ChunkedArray(fname).'''
+    arr = np.asarray(arr)
+    with ChunkedArray(fname, mode='w', dtype=arr.dtype, row_shape=arr.shape[1:], chunk_rows=chunk_rows,
+                      compression=compression, level=level) as c:
+        c.append(arr)
 
 
-def load_array(fname):
-    return bcolz.open(fname)[:]
+def load_array(fname, rows=None):
+    '''
+    Loads an array written by save_array. rows: optional slice/index array to read only those rows
+    (only the chunks holding them are decompressed). Old bcolz directories are still read via bcolz.
+    '''
+    if not os.path.exists(os.path.join(fname, 'header.json')):
+        import bcolz # legacy save_array format
+        c = bcolz.open(fname)
+        return c[:] if rows is None else c[rows]
+    c = ChunkedArray(fname)
+    return c[:] if rows is None else c[rows]
 
 
 
 # Criag Glastonbury 23rd on PB LB (0.5 logloss) did a preprocessing of normalizing the RGB histogram with
 # Obvly it gave him great results than us (~1 logloss) :/
-def normalized(rgb):
-    norm=np.zeros((rgb.shape[0], rgb.shape[1], 3),np.float32)
-    b=rgb[:,:,0]
-    g=rgb[:,:,1]
-    r=rgb[:,:,2]
-    norm[:,:,0]=cv2.equalizeHist(b)
-    norm[:,:,1]=cv2.equalizeHist(g)
-    norm[:,:,2]=cv2.equalizeHist(r)
+def normalized(rgb, dtype=np.float32):
+    norm=np.empty((rgb.shape[0], rgb.shape[1], 3), dtype)
+    for c in range(3):
+        norm[:,:,c]=cv2.equalizeHist(np.ascontiguousarray(rgb[:,:,c]))
     return norm
 
-def get_im_cv2(path):
-    img = cv2.imread(path,1)
-    
-    # For color historgram
-    img_yuv = cv2.cvtColor(img, cv2.COLOR_BGR2YUV)
 
-    # equalize the histogram of the Y channel
-    img_yuv[:,:,0] = cv2.equalizeHist(img_yuv[:,:,0])
+# 5x5 edge enhancing sharpen kernel used by get_im_cv2
+kernel_sharpen_3 = np.array([[-1,-1,-1,-1,-1],
+                             [-1, 2, 2, 2,-1],
+                             [-1, 2, 8, 2,-1],
+                             [-1, 2, 2, 2,-1],
+                             [-1,-1,-1,-1,-1]]) / 8.0
+
 
-    # convert the YUV image back to RGB format
-    img_output = cv2.cvtColor(img_yuv, cv2.COLOR_YUV2BGR)
+def preprocess_im_cv2(img, size=(224, 224), sharpen_kernel=kernel_sharpen_3, equalize='yuv'):
+    '''
+    The get_im_cv2 steps on an already decoded BGR image.
+    equalize: 'yuv' equalizes the Y channel (default), 'rgb' every channel (normalized), None skips it.
+    sharpen_kernel: None skips sharpening. size: (width, height) of the output.
+    '''
+    if equalize == 'yuv':
+        # For color historgram
+        img_yuv = cv2.cvtColor(img, cv2.COLOR_BGR2YUV)
+
+        # equalize the histogram of the Y channel
+        img_yuv[:,:,0] = cv2.equalizeHist(img_yuv[:,:,0])
+
+        # convert the YUV image back to RGB format
+        img = cv2.cvtColor(img_yuv, cv2.COLOR_YUV2BGR)
+    elif equalize == 'rgb':
+        img = normalized(img, dtype=np.uint8)
     
     # Sharpen
-    output_3 = cv2.filter2D(img_output, -1, kernel_sharpen_3)
+    if sharpen_kernel is not None:
+        img = cv2.filter2D(img, -1, sharpen_kernel)
     
     # Reduce to manageable size
-    resized = cv2.resize(output_3, (224, 224), interpolation = cv2.INTER_LINEAR)
-    return resized
-    
+    return cv2.resize(img, tuple(size), interpolation = cv2.INTER_LINEAR)
+
+
+def get_im_cv2(path, size=(224, 224), sharpen_kernel=kernel_sharpen_3, equalize='yuv'):
+    img = cv2.imread(path,1)
+    if img is None:
+        raise IOError('Could not decode image '+str(path))
+    return preprocess_im_cv2(img, size=size, sharpen_kernel=sharpen_kernel, equalize=equalize)
+
+
+def _preprocess_settings_key(size, sharpen_kernel, equalize):
+    hasher = hashlib.sha1(repr((tuple(size), equalize)).encode('utf-8'))
+    if sharpen_kernel is not None:
+        hasher.update(np.ascontiguousarray(sharpen_kernel, dtype=np.float64).tobytes())
+    return hasher.hexdigest()[:12]
+
+
+def _preprocess_im_cached(path, size, sharpen_kernel, equalize, cache_dir, settings_key):
+    raw = np.fromfile(path, dtype=np.uint8) # read once: hashed for the cache and decoded from memory
+    cachefile = None
+    if cache_dir is not None:
+        key = hashlib.sha256(raw).hexdigest() + '_' + settings_key
+        cachefile = os.path.join(cache_dir, key[:2], key+'.npy')
+        if os.path.exists(cachefile):
+            return np.load(cachefile)
+    img = cv2.imdecode(raw, 1)
+    if img is None:
+        raise IOError('Could not decode image '+str(path))
+    img = preprocess_im_cv2(img, size=size, sharpen_kernel=sharpen_kernel, equalize=equalize)
+    if cachefile is not None:
+        if not os.path.isdir(os.path.dirname(cachefile)):
+            os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        tmp = cachefile + '.tmp%d.npy' % os.getpid()
+        np.save(tmp, img)
+        os.replace(tmp, cachefile)
+    return img
+
+
+_preprocess_worker_out = {}
+
+def _preprocess_worker_init():
+    cv2.setNumThreads(1) # the pool provides the parallelism
+
+
+def _preprocess_im_into(args):
+    i, path, size, sharpen_kernel, equalize, cache_dir, settings_key, out_file, shape = args
+    img = _preprocess_im_cached(path, size, sharpen_kernel, equalize, cache_dir, settings_key)
+    if out_file is None:
+        return i, img
+    if _preprocess_worker_out.get('file') != out_file:
+        _preprocess_worker_out['file'] = out_file
+        _preprocess_worker_out['out'] = np.memmap(out_file, dtype=np.uint8, mode='r+', shape=shape)
+    _preprocess_worker_out['out'][i] = img # shared file mapping, visible to the main process without a flush
+    return i, None
+
+
+def preprocess_images(paths, size=(224, 224), sharpen_kernel=kernel_sharpen_3, equalize='yuv', n_jobs=None,
+                      out=None, out_file=None, cache_dir=None, chunksize=16):
+    '''
+    get_im_cv2 over a list of image files with a process pool, into one preallocated uint8 array of
+    shape (len(paths), size[1], size[0], 3).
+    
+    out: preallocated uint8 array to fill (eg. np.zeros or a memmap of that shape)
+    out_file: instead, a .dat file that is created as a uint8 memmap; the workers write straight into it, so
+    no pixels are pickled back to the main process. Reopen it with np.memmap(out_file, np.uint8, 'r', shape=...).
+    cache_dir: on-disk cache of preprocessed images keyed by the sha256 of the file contents and the
+    preprocessing settings (size, sharpen_kernel, equalize) - reruns and renamed/copied files only pay for
+    the hash and a np.load.
+    n_jobs: number of processes (default: all cpus). size, sharpen_kernel, equalize: as in preprocess_im_cv2.
+    
+    Returns the filled array (a memmap if out_file).
+    '''
+    paths = list(paths)
+    shape = (len(paths), size[1], size[0], 3)
+    if out_file is not None:
+        out = np.memmap(out_file, dtype=np.uint8, mode='w+', shape=shape)
+        out.flush()
+    elif out is None:
+        out = np.empty(shape, dtype=np.uint8)
+    settings_key = _preprocess_settings_key(size, sharpen_kernel, equalize)
+    
+    tasks = ((i, path, size, sharpen_kernel, equalize, cache_dir, settings_key, out_file, shape)
+             for i, path in enumerate(paths))
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_preprocess_worker_init) as pool:
+        for i, img in pool.map(_preprocess_im_into, tasks, chunksize=chunksize):
+            if img is not None:
+                out[i] = img
+    if out_file is not None:
+        out = np.memmap(out_file, dtype=np.uint8, mode='r+', shape=shape)
+    return out
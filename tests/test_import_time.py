@@ -0,0 +1,29 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# wall time of a fresh `python -c "import <module>"`, interpreter startup included: about 0.4s (numpy +
+# pandas) on a laptop, so the budget leaves room for a slow CI box while a heavy module loaded at import
+# time (cv2, numba, xgboost, lightgbm, sklearn, matplotlib ...) takes seconds and fails it
+IMPORT_BUDGET = 1.5
+HEAVY = ['cv2', 'numba', 'xgboost', 'lightgbm', 'matplotlib', 'seaborn', 'sklearn', 'scipy', 'bcolz']
+
+
+def _import(module):
+    code = 'import sys, json; import %s; print(json.dumps([m for m in %r if m in sys.modules]))' % (module, HEAVY)
+    start = time.time()
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=REPO)
+    return time.time() - start, json.loads(out.decode().strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize('module', ['xtune', 'mltools', 'xmetrics'])
+def test_import_is_light(module):
+    elapsed, loaded = min(_import(module) for i in range(3)) # best of 3 against a busy machine
+    assert loaded == []
+    assert elapsed < IMPORT_BUDGET, '%s took %.2fs to import (budget %.1fs)' % (module, elapsed, IMPORT_BUDGET)
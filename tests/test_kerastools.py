@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('h5py')
+keras = pytest.importorskip('keras')
+
+import kerastools
+
+
+def _model():
+    model = keras.models.Sequential([keras.layers.Dense(8, activation='relu', input_shape=(10,)),
+                                     keras.layers.Dense(2, activation='softmax')])
+    model.compile('adam', 'categorical_crossentropy')
+    return model
+
+
+def _data(n=600):
+    rng = np.random.RandomState(0)
+    x = rng.randn(n, 10).astype(np.float32)
+    y = np.eye(2, dtype=np.float32)[(x[:, 0] + 0.5 * rng.randn(n) > 0).astype(int)]
+    return x, y
+
+
+@pytest.mark.parametrize('name', ['model.h5', 'model.keras', 'model_dir'])
+def test_async_save_round_trip(tmp_path, name):
+    x, y = _data()
+    model = _model()
+    model.fit(x, y, epochs=1, verbose=0)
+    expected = model.predict(x, verbose=0)
+    
+    filepath = str(tmp_path / name)
+    saver = kerastools.AsyncModelSaver()
+    saver.save(model, filepath, {filepath + '.metrics.txt': 'VAL AUC: 1\n'})
+    model.fit(x, y, epochs=1, verbose=0) # the snapshot is taken in save(), later training does not leak in
+    saver.flush()
+    loaded = keras.models.load_model(filepath)
+    np.testing.assert_allclose(loaded.predict(x, verbose=0), expected, rtol=1e-6)
+    
+    saver.save(model, filepath) # overwrites the checkpoint (a directory for SavedModel)
+    saver.close()
+    assert not saver._thread.is_alive()
+    loaded = keras.models.load_model(filepath)
+    np.testing.assert_allclose(loaded.predict(x, verbose=0), model.predict(x, verbose=0), rtol=1e-6)
+    assert open(filepath + '.metrics.txt').read() == 'VAL AUC: 1\n'
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted([name, name + '.metrics.txt'])
+
+
+def test_checkpoint_async_save_and_log(tmp_path):
+    x, y = _data()
+    model = _model()
+    filepath = str(tmp_path / 'best.h5')
+    callback = kerastools.ModelCheckpointAUC((x[:200], y[:200]), filepath=filepath, save_model=True,
+                                             train_data=(x[200:], y[200:]), logfile=str(tmp_path / 'log.txt'),
+                                             async_save=True)
+    model.fit(x[200:], y[200:], epochs=2, callbacks=[callback], verbose=0)
+    
+    assert callback.log.closed
+    assert callback.saver is None # closed in on_train_end, no thread left behind
+    assert len(open(str(tmp_path / 'log.txt')).read().strip().split('\n')) == 4 # separator, header, 2 epochs
+    best = keras.models.load_model(filepath)
+    assert best.predict(x[:5], verbose=0).shape == (5, 2)
@@ -0,0 +1,67 @@
+import numpy as np
+
+import mltools
+
+
+def _chunked(tmp_path, x, compression):
+    with mltools.ChunkedArray(str(tmp_path / 'x.xca'), mode='w', dtype=x.dtype, row_shape=x.shape[1:],
+                              chunk_rows=4, compression=compression) as ca:
+        ca.append(x)
+    return mltools.ChunkedArray(str(tmp_path / 'x.xca'))
+
+
+def test_chunked_array_repeated_sorted_rows(tmp_path):
+    x = np.arange(40, dtype=np.float32).reshape(20, 2)
+    for compression in (None, 'zlib'):
+        ca = _chunked(tmp_path, x, compression)
+        for idx in ([0, 0, 2], [4, 5, 5, 6], [1, 1, 1, 1], [0, 1, 2, 3, 3, 9, 10, 11, 19, 19]):
+            idx = np.array(idx)
+            np.testing.assert_array_equal(ca[idx], x[idx])
+
+
+def test_chunked_array_gathers(tmp_path):
+    rng = np.random.RandomState(0)
+    x = rng.rand(103, 3)
+    ca = _chunked(tmp_path, x, 'zlib')
+    for idx in (np.sort(rng.choice(103, 50, replace=False)), rng.randint(0, 103, 200), np.arange(5, 99)):
+        np.testing.assert_array_equal(ca[idx], x[idx])
+        np.testing.assert_array_equal(ca[idx, 1], x[idx, 1])
+
+
+def test_caruana_keeps_the_initial_blend_when_adding_hurts():
+    rng = np.random.RandomState(0)
+    y = rng.randint(0, 2, 500)
+    e = 2 * rng.randn(500)
+    # a and b are noisy alone but exact together: any third model only makes the blend worse
+    preds = np.column_stack([y + e, y - e, rng.rand(500, 3)])
+    selected, score = mltools.caruanaFitter(preds, y, metric='auc', n_steps=5, n_bags=1, init_size=2, verbose=False)
+    assert selected == {0: 0.5, 1: 0.5}
+    assert score == 1.0
+
+
+def test_find_dup_output(tmp_path):
+    for name, content in [('a', b'x' * 100), ('b', b'x' * 100), ('c', b'y' * 100), ('d', b'unique size')]:
+        (tmp_path / name).write_bytes(content)
+    everything = mltools.findDup(str(tmp_path))
+    assert sorted(len(group) for group in everything.values()) == [1, 1, 2]
+    dups = mltools.findDup(str(tmp_path), prefilter=True)
+    assert len(dups) == 1
+    file_hash, group = dups.popitem()
+    assert sorted(group) == sorted(everything[file_hash]) == [str(tmp_path / 'a'), str(tmp_path / 'b')]
+
+
+def test_stacked_preds_averager_blocks():
+    rng = np.random.RandomState(0)
+    P = (rng.rand(9, 1001, 2) + 0.01).astype(np.float32)
+    w = rng.rand(9)
+    P64 = P.astype(np.float64)
+    expected = {'AM': np.tensordot(w, P64, axes=1) / w.sum(),
+                'GM': np.exp(np.tensordot(w / w.sum(), np.log(P64), axes=1)),
+                'HM': w.sum() * 9 / np.tensordot(w, 1 / P64, axes=1)}
+    for type, mean in expected.items():
+        mean = mean / mean.sum(axis=1, keepdims=True)
+        for max_bytes in (2**12, 2**16, 2**28): # one model per block, a few per block, all at once
+            out = mltools.stacked_preds_averager(P, w, type, max_bytes=max_bytes)
+            np.testing.assert_allclose(out, mean, rtol=1e-6)
+        listed = mltools.stacked_preds_averager(list(P), w, type, max_bytes=2**16)
+        np.testing.assert_allclose(listed, mean, rtol=1e-6)
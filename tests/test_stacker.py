@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+for dependency in ('xgboost', 'lightgbm', 'catboost', 'rgf', 'sklearn'):
+    pytest.importorskip(dependency)
+
+from sklearn.linear_model import LogisticRegression
+
+import xtune
+from kaggletools import stacker
+
+
+def _data(n=1500, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.rand(n, 6)
+    y = (X[:, 0] + 0.5 * rng.rand(n) > 0.75).astype(int)
+    return X, y
+
+
+@pytest.mark.parametrize('param', [
+    {'boosting_alg': 'xgb', 'objective': 'binary:logistic', 'eval_metric': 'logloss', 'num_estimators': 1000,
+     'early_stopping': 10, 'eta': 0.3},
+    {'boosting_alg': 'lgb', 'objective': 'binary', 'metric': 'binary_logloss', 'num_estimators': 1000,
+     'early_stopping': 10, 'learning_rate': 0.3, 'verbose': -1},
+])
+def test_native_models_fit_and_predict_at_best_iteration(param):
+    X, y = _data()
+    T, _ = _data(300, seed=1)
+    stack = stacker.Stacker(n_splits=3, stacker=LogisticRegression(), base_models=(param,))
+    stack.fit(X, y)
+    
+    for model in stack.fold_models_[0]:
+        booster = model.model
+        if model.boosting_alg == 'xgb':
+            best = int(booster.attr('best_iteration')) + 1
+            assert best < booster.num_boosted_rounds() # early stopped on the fold holdout
+            expected = booster.predict(xtune.xgb.DMatrix(T), iteration_range=(0, best))
+        else:
+            assert 0 < booster.best_iteration < param['num_estimators']
+            expected = booster.predict(T, num_iteration=booster.best_iteration)
+        np.testing.assert_allclose(model.predict(T), expected, rtol=1e-6)
+    
+    pred = stack.predict(T)
+    assert pred.shape == (300,)
+    assert np.all((pred >= 0) & (pred <= 1))
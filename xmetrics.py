@@ -0,0 +1,253 @@
+'''
+Compiled metric kernels shared by xtune, mltools and kerastools.
+
+All kernels are nopython numba functions cached on disk (cache=True), so they compile once per machine and
+not on every import/worker; numba is only imported on the first kernel call. The binary kernels take an optional order - the indices that sort y_prob
+ascending (see sort_order) - so several metrics over the same predictions share one sort:
+
+    order = sort_order(y_prob)
+    a = auc(y_true, y_prob, order)
+    g = gini(y_true, y_prob, order)
+    p, r = precision_recall_at(y_true, y_prob, 0.5, order)
+
+Run this file to check the kernels against sklearn and time them.
+'''
+from __future__ import print_function
+import numpy as np
+
+_kernels = []
+_compiled = []
+
+
+def lazy_njit(func):
+    '''
+    Registers a numba kernel. numba itself is only imported on the first kernel call, when every registered
+    kernel is wrapped in numba.njit(cache=True) at once (so kernels can call each other), keeping
+    `import xmetrics` cheap.
+    '''
+    _kernels.append(func.__name__)
+    
+    def first_call(*args):
+        _compile_kernels()
+        return globals()[func.__name__](*args)
+    first_call.py_func = func
+    first_call.__name__ = func.__name__
+    first_call.__doc__ = func.__doc__
+    return first_call
+
+
+def _compile_kernels():
+    if _compiled:
+        return
+    import numba
+    module = globals()
+    for name in _kernels:
+        module[name] = numba.njit(cache=True)(module[name].py_func)
+    _compiled.append(True)
+
+
+def sort_order(y_prob):
+    '''Indices that sort y_prob ascending (stable). Pass it to the kernels to share the sort.'''
+    return np.argsort(np.asarray(y_prob), kind='mergesort')
+
+
+def _as_binary_args(y_true, y_prob, order):
+    y_true = np.ascontiguousarray(y_true, dtype=np.float64).ravel()
+    y_prob = np.ascontiguousarray(y_prob, dtype=np.float64).ravel()
+    if order is None:
+        order = sort_order(y_prob)
+    return y_true, y_prob, np.ascontiguousarray(order, dtype=np.int64)
+
+
+@lazy_njit
+def _auc_kernel(y_true, y_prob, order):
+    n = order.shape[0]
+    npos = 0.0
+    nneg = 0.0
+    area = 0.0
+    i = 0
+    while i < n:
+        # one group of tied scores: positives beat every negative below and half of the tied negatives
+        value = y_prob[order[i]]
+        gpos = 0.0
+        gneg = 0.0
+        j = i
+        while j < n and y_prob[order[j]] == value:
+            if y_true[order[j]] > 0.5:
+                gpos += 1.0
+            else:
+                gneg += 1.0
+            j += 1
+        area += gpos * nneg + 0.5 * gpos * gneg
+        npos += gpos
+        nneg += gneg
+        i = j
+    if npos == 0.0 or nneg == 0.0:
+        return np.nan
+    return area / (npos * nneg)
+
+
+@lazy_njit
+def _auc_columns_kernel(y_true, scores, orders):
+    k = scores.shape[1]
+    out = np.empty(k)
+    for col in range(k):
+        out[col] = _auc_kernel(y_true, scores[:, col], orders[:, col])
+    return out
+
+
+@lazy_njit
+def _logloss_kernel(y_true, y_prob, eps):
+    n = y_true.shape[0]
+    total = 0.0
+    for i in range(n):
+        p = min(max(y_prob[i], eps), 1.0 - eps)
+        if y_true[i] > 0.5:
+            total += np.log(p)
+        else:
+            total += np.log(1.0 - p)
+    return -total / n
+
+
+@lazy_njit
+def _logloss_columns_kernel(y_true, scores, eps):
+    k = scores.shape[1]
+    out = np.empty(k)
+    for col in range(k):
+        out[col] = _logloss_kernel(y_true, scores[:, col], eps)
+    return out
+
+
+@lazy_njit
+def _multiclass_logloss_kernel(actual, y_pred, eps):
+    n, c = y_pred.shape
+    total = 0.0
+    for i in range(n):
+        rowsum = 0.0
+        for j in range(c):
+            rowsum += min(max(y_pred[i, j], eps), 1.0 - eps)
+        for j in range(c):
+            if actual[i, j] != 0.0:
+                total += actual[i, j] * np.log(min(max(y_pred[i, j], eps), 1.0 - eps) / rowsum)
+    return -total / n
+
+
+@lazy_njit
+def _precision_recall_kernel(y_true, y_prob, cutoff, order):
+    n = order.shape[0]
+    # first position (in ascending order) predicted positive, ie. y_prob > cutoff
+    lo = 0
+    hi = n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if y_prob[order[mid]] > cutoff:
+            hi = mid
+        else:
+            lo = mid + 1
+    tp = 0.0
+    npos = 0.0
+    for i in range(n):
+        if y_true[order[i]] > 0.5:
+            npos += 1.0
+            if i >= lo:
+                tp += 1.0
+    npred = float(n - lo)
+    precision = tp / npred if npred > 0 else 0.0
+    recall = tp / npos if npos > 0 else 0.0
+    return precision, recall
+
+
+def auc(y_true, y_prob, order=None):
+    '''Tie-corrected ROC AUC for binary y_true (same as sklearn roc_auc_score).'''
+    y_true, y_prob, order = _as_binary_args(y_true, y_prob, order)
+    return _auc_kernel(y_true, y_prob, order)
+
+
+def gini(y_true, y_prob, order=None):
+    '''Normalized Gini coefficient, 2*AUC - 1 (ties counted half, unlike the sort-order dependent loop).'''
+    return 2.0 * auc(y_true, y_prob, order) - 1.0
+
+
+def auc_columns(y_true, scores, orders=None):
+    '''AUC of every column of scores (n_rows, k). orders: argsort of scores along axis 0, if already known.'''
+    y_true = np.ascontiguousarray(y_true, dtype=np.float64).ravel()
+    scores = np.asarray(scores, dtype=np.float64)
+    if orders is None:
+        orders = np.argsort(scores, axis=0, kind='mergesort')
+    return _auc_columns_kernel(y_true, scores, np.asarray(orders, dtype=np.int64))
+
+
+def logloss(y_true, y_prob, eps=1e-15):
+    '''Binary log loss of the class 1 probabilities y_prob.'''
+    y_true = np.ascontiguousarray(y_true, dtype=np.float64).ravel()
+    y_prob = np.ascontiguousarray(y_prob, dtype=np.float64).ravel()
+    return _logloss_kernel(y_true, y_prob, eps)
+
+
+def logloss_columns(y_true, scores, eps=1e-15):
+    '''Binary log loss of every column of scores (n_rows, k).'''
+    y_true = np.ascontiguousarray(y_true, dtype=np.float64).ravel()
+    return _logloss_columns_kernel(y_true, np.asarray(scores, dtype=np.float64), eps)
+
+
+def multiclass_logloss(actual, y_pred, eps=1e-15):
+    '''
+    Multi class log loss. actual is either one hot (n_rows, n_classes) or class labels (n_rows,).
+    Predictions are clipped and row normalized on the fly, y_pred is not modified.
+    '''
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    actual = np.asarray(actual)
+    if actual.ndim == 1:
+        onehot = np.zeros(y_pred.shape)
+        onehot[np.arange(len(actual)), actual.astype(np.int64)] = 1.0
+        actual = onehot
+    return _multiclass_logloss_kernel(np.asarray(actual, dtype=np.float64), y_pred, eps)
+
+
+def precision_recall_at(y_true, y_prob, cutoff=0.5, order=None):
+    '''Precision and recall when predicting class 1 for y_prob > cutoff.'''
+    y_true, y_prob, order = _as_binary_args(y_true, y_prob, order)
+    return _precision_recall_kernel(y_true, y_prob, float(cutoff), order)
+
+
+def benchmark(n=1000000, seed=28081994):
+    '''Checks the kernels against sklearn and prints the timings of both.'''
+    import time
+    from sklearn.metrics import roc_auc_score, log_loss, precision_score, recall_score
+
+    rng = np.random.RandomState(seed)
+    y_true = (rng.rand(n) < 0.3).astype(np.float64)
+    y_prob = np.clip(0.3 * y_true + rng.rand(n), 0, 1).round(3) # rounded to get plenty of ties
+    probs3 = rng.dirichlet(np.ones(3), size=n)
+    labels3 = rng.randint(0, 3, size=n)
+
+    auc(y_true[:10], y_prob[:10]), logloss(y_true[:10], y_prob[:10]) # compile (or load from cache)
+    multiclass_logloss(labels3[:10], probs3[:10]), precision_recall_at(y_true[:10], y_prob[:10])
+
+    checks = [
+        ('auc', lambda: roc_auc_score(y_true, y_prob), lambda: auc(y_true, y_prob)),
+        ('gini', lambda: 2 * roc_auc_score(y_true, y_prob) - 1, lambda: gini(y_true, y_prob)),
+        ('logloss', lambda: log_loss(y_true, np.clip(y_prob, 1e-15, 1 - 1e-15)), lambda: logloss(y_true, y_prob)),
+        ('multiclass_logloss', lambda: log_loss(labels3, probs3), lambda: multiclass_logloss(labels3, probs3)),
+        ('precision@0.5', lambda: precision_score(y_true, y_prob > 0.5),
+         lambda: precision_recall_at(y_true, y_prob, 0.5)[0]),
+        ('recall@0.5', lambda: recall_score(y_true, y_prob > 0.5),
+         lambda: precision_recall_at(y_true, y_prob, 0.5)[1]),
+    ]
+    for name, ref, fast in checks:
+        t0 = time.time()
+        expected = ref()
+        t1 = time.time()
+        got = fast()
+        t2 = time.time()
+        print('{:<20} sklearn {:.8f} ({:.3f}s)  xmetrics {:.8f} ({:.3f}s)'.format(name, expected, t1 - t0, got, t2 - t1))
+        assert abs(expected - got) < 1e-7, name
+
+    t0 = time.time()
+    order = sort_order(y_prob)
+    auc(y_true, y_prob, order), gini(y_true, y_prob, order), precision_recall_at(y_true, y_prob, 0.5, order)
+    print('auc+gini+precision/recall sharing one sort: {:.3f}s'.format(time.time() - t0))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -5,18 +5,18 @@ Created on Nov 08, 2017
 '''
 
 from __future__ import print_function
-import os, pickle
-from sklearn.model_selection import ParameterGrid
-from sklearn.model_selection import StratifiedKFold
+import os, pickle, json, inspect
 import numpy as np
-from numba import jit # Compile intensive functions inline to C code for faster perf
-import xgboost as xgb
-from sklearn.metrics import roc_auc_score, log_loss
+import xmetrics # Compiled (numba, cached) metric kernels
 import sys, gc
 import pandas as pd
-import matplotlib.pyplot as plt 
-import lightgbm as lgb
-from mltools import *
+from mltools import * # one way only: mltools does not import xtune
+from lazyimport import LazyModule
+
+# Heavy dependencies are imported on first use (see lazyimport)
+xgb = LazyModule('xgboost')
+lgb = LazyModule('lightgbm')
+sk_model_selection = LazyModule('sklearn.model_selection')
 '''
 TODOS -
 Caliberating the predictions
@@ -50,28 +50,15 @@ class Logger(object):
         pass 
 
 
-@jit
-def eval_gini(y_true, y_prob):
+def eval_gini(y_true, y_prob, order=None):
     '''
     Normalized Gini Coefficient Measure -- somewhat related to the AUC -- but more related to the ordering of the predictions.
     Used in Kaggle for instance in the Safe Driver Prediction Challenge (binary classification pure xgboost competition).
-    Implementation by CPMP.
+    Computed by the compiled, tie-corrected xmetrics.gini (2*AUC - 1). Pass order=xmetrics.sort_order(y_prob)
+    to share the sort with other xmetrics kernels.
     '''
-    y_true = np.asarray(y_true)
-    y_true = y_true[np.argsort(y_prob)]
-    ntrue = 0
-    gini = 0
-    delta = 0
-    n = len(y_true)
-    for i in range(n-1, -1, -1):
-        y_i = y_true[i]
-        ntrue += y_i
-        gini += y_i * delta
-        delta += 1 - y_i
-    gini = 1 - 2 * gini / (ntrue * (n - ntrue))
-    return gini
-
-@jit
+    return xmetrics.gini(y_true, y_prob, order)
+
 def multiclass_log_loss(actual, y_pred, eps=1e-15):
     """Multi class version of Logarithmic Loss metric.
     https://www.kaggle.com/wiki/MultiClassLogLoss
@@ -79,20 +66,13 @@ def multiclass_log_loss(actual, y_pred, eps=1e-15):
     http://www.kaggle.com/c/emc-data-science/forums/t/2149/is-anyone-noticing-difference-betwen-validation-and-leaderboard-error/12209#post12209
     Parameters
     ----------
-    y_true : array, shape = [n_samples]
+    y_true : array, shape = [n_samples, n_classes] one hot (or [n_samples] class labels)
     y_pred : array, shape = [n_samples, n_classes]
     Returns
     -------
     loss : float
     """
-    predictions = np.clip(y_pred, eps, 1 - eps)
-
-    # normalize row sums to 1
-    predictions /= predictions.sum(axis=1)[:, np.newaxis]
-    rows = actual.shape[0]
-
-    vsota = np.sum(actual * np.log(predictions))
-    return -1.0 / rows * vsota
+    return xmetrics.multiclass_logloss(actual, y_pred, eps)
 
 def xgb_gini(pred, d_eval): 
     # more is better like auc; only for binary problems
@@ -112,9 +92,11 @@ def xgb_gini(pred, d_eval):
         print('Not valid for non-binary problems.')
         raise
     
-    gini_score = eval_gini(obs, pred[:,1])
+    order = xmetrics.sort_order(pred[:,-1]) # one sort for both gini and auc
+    gini_score = eval_gini(obs, pred[:,-1], order)
+    auc_score = xmetrics.auc(obs, pred[:,-1], order)
 
-    return [('kaglloss', multiclass_log_loss(np.array(obs_onehot).astype(float), pred)), ('gini', gini_score), ('auc', roc_auc_score(np.array(obs_onehot).astype(float), pred))]
+    return [('kaglloss', multiclass_log_loss(np.array(obs_onehot).astype(float), pred)), ('gini', gini_score), ('auc', auc_score)]
 
 def xgb_auc(pred, d_eval):
     '''
@@ -141,7 +123,7 @@ def xgb_auc(pred, d_eval):
         print('Not valid for non-binary problems.')
         raise
 
-    return [('kaglloss', multiclass_log_loss(np.array(obs_onehot).astype(float), pred)), ('auc', roc_auc_score(np.array(obs_onehot).astype(float), pred))]
+    return [('kaglloss', multiclass_log_loss(np.array(obs_onehot).astype(float), pred)), ('auc', xmetrics.auc(obs, pred[:,-1]))]
     
     
 def xPredict( model, d_pred, boosting_alg='xgb', lgb_best_iteration=-1, usealltreestopredict=False):
@@ -155,15 +137,21 @@ def xPredict( model, d_pred, boosting_alg='xgb', lgb_best_iteration=-1, usealltr
     
     if boosting_alg=='xgb':
         if usealltreestopredict:
-            ntree_limit = 0 # default to make sure all tree are used
-        else:
+            return model.predict(d_pred)
+        best_iteration = model.attr('best_iteration') # set by early stopping, kept in the booster
+        if best_iteration is not None:
             try:
-                ntree_limit = model.best_ntree_limit
-            except:
-                print('Getting error on trying ntree_limit. Proceeding with all trees.')
-                ntree_limit = 0
+                return model.predict(d_pred, iteration_range=(0, int(best_iteration) + 1))
+            except TypeError: # xgboost < 1.4: no iteration_range, best_ntree_limit below
+                pass
+            except Exception: # some problems occurred before with gblinear booster
+                print('Getting error on trying iteration_range. Proceeding with all trees.')
+                return model.predict(d_pred)
+        ntree_limit = getattr(model, 'best_ntree_limit', 0)
+        if not ntree_limit:
+            return model.predict(d_pred)
         try:
-            return model.predict(d_pred, ntree_limit=ntree_limit) # some problems occurred before with gblinear booster
+            return model.predict(d_pred, ntree_limit=ntree_limit)
         except:
             print('Getting error on trying ntree_limit. Proceeding with all trees.')
             return model.predict(d_pred)
@@ -175,10 +163,119 @@ def xPredict( model, d_pred, boosting_alg='xgb', lgb_best_iteration=-1, usealltr
         print('Boosting should be either xgb or lgb. No valid option passed.')
         raise
 
+def _best_ntree_limit(model):
+    '''Boosting rounds up to the best iteration of an early stopped xgb booster (best_ntree_limit of old xgboost).'''
+    best_iteration = model.attr('best_iteration')
+    if best_iteration is not None:
+        return int(best_iteration) + 1
+    return getattr(model, 'best_ntree_limit', 0)
+
+def xExport(model, path, boosting_alg='xgb', num_rounds=None, meta=None, truncate=True):
+    '''
+    Writes a trained xgb/lgb booster in its native format (no pickle), truncated to its first num_rounds
+    boosting rounds, plus path+'.meta.json' with the metadata (boosting_alg, num_rounds, total_rounds and
+    anything in meta). Load it with xLoad and predict with all trees - no ntree_limit/best_iteration bookkeeping:
+    
+        model, meta = xLoad(path)
+        pred = xPredict(model, d_pred, meta['boosting_alg'])
+    
+    num_rounds: boosting rounds to keep (eg. the early stopping best iteration + 1). If None, the model's own
+    best iteration is used when set (xgb best_iteration, lgb best_iteration), else all rounds.
+    truncate=False keeps all rounds (like usealltreestopredict).
+    Old xgboost without Booster slicing keeps all trees and stores the limit in the metadata instead.
+    '''
+    meta = dict(meta or {})
+    meta['boosting_alg'] = boosting_alg
+    if not truncate:
+        num_rounds = None
+    
+    if boosting_alg=='xgb':
+        if truncate and num_rounds is None and getattr(model, 'best_iteration', None) is not None:
+            num_rounds = int(model.best_iteration) + 1
+        total_rounds = model.num_boosted_rounds() if hasattr(model, 'num_boosted_rounds') else None
+        if num_rounds is not None and num_rounds != total_rounds:
+            try:
+                model = model[:num_rounds]
+            except (TypeError, AttributeError, NotImplementedError): # no Booster slicing in this xgboost
+                meta['ntree_limit'] = num_rounds
+        model.save_model(path)
+        
+    elif boosting_alg=='lgb':
+        if truncate and num_rounds is None and getattr(model, 'best_iteration', 0) > 0:
+            num_rounds = model.best_iteration
+        total_rounds = model.current_iteration()
+        model.save_model(path, num_iteration=num_rounds if num_rounds is not None else -1)
+
+    else:
+        print('Boosting should be either xgb or lgb. No valid option passed.')
+        raise ValueError(boosting_alg)
+    
+    meta['num_rounds'] = num_rounds if num_rounds is not None else total_rounds
+    meta['total_rounds'] = total_rounds
+    with open(path+'.meta.json', 'w') as f:
+        json.dump(meta, f, indent=1, default=str)
+    return meta
+
+
+def xLoad(path):
+    '''Loads a booster written by xExport. Returns (model, meta); predict with xPredict(model, d_pred, meta['boosting_alg']).'''
+    with open(path+'.meta.json') as f:
+        meta = json.load(f)
+    if meta['boosting_alg']=='xgb':
+        model = xgb.Booster(model_file=path)
+        model.set_attr(best_iteration=None) # all trees, the file is already truncated
+        model.best_ntree_limit = meta.get('ntree_limit', 0) # old xgboost without Booster slicing
+    else:
+        model = lgb.Booster(model_file=path)
+    return model, meta
+
+
+def saveModel(model, basepath, boosting_alg='xgb', model_format='pickle', best_limit=None, param=None, score=None,
+              usealltreestopredict=False):
+    '''
+    Saves one model pool model: basepath+'.model' pickle, or (model_format='native') basepath+'.native' cut to
+    best_limit rounds via xExport, with the param and score in the metadata.
+    '''
+    if model_format=='native':
+        xExport(model, basepath+'.native', boosting_alg, num_rounds=best_limit,
+                meta={'param': param, 'score': score}, truncate=not usealltreestopredict)
+    else:
+        fmodel = open(basepath+'.model', 'wb')
+        pickle.dump(model, fmodel)
+        fmodel.close()
+
+
+def exportModelPool(modelpool_dir='./model_pool', remove_pickles=False):
+    '''
+    xExport for every pickled model in modelpool_dir/model (as saved by xGridSearch with save_models=True),
+    truncated to the best iteration the booster recorded. Writes <name>.native and <name>.native.meta.json
+    next to <name>.model; remove_pickles deletes the pickles once exported. Returns the list of exported paths.
+    '''
+    exported = []
+    for f in sorted(os.listdir(modelpool_dir+'/model/')):
+        if not f.endswith('.model'):
+            continue
+        model = get(modelpool_dir+'/model/'+f)
+        boosting_alg = 'lgb' if type(model).__module__.startswith('lightgbm') else 'xgb'
+        num_rounds = None
+        if boosting_alg=='xgb' and getattr(model, 'best_iteration', None) is None and getattr(model, 'best_ntree_limit', 0):
+            num_rounds = int(model.best_ntree_limit) # older xgboost: best_ntree_limit only (rounds, for num_parallel_tree=1)
+        path = modelpool_dir+'/model/'+f.split('.model')[0]+'.native'
+        meta = xExport(model, path, boosting_alg, num_rounds, meta={'source': f})
+        print('Exported', f, 'with', meta['num_rounds'], 'of', meta['total_rounds'], 'rounds')
+        exported.append(path)
+        if remove_pickles:
+            os.remove(modelpool_dir+'/model/'+f)
+    return exported
+
+
 def gcRefresh():
     gc.collect()
 
 
+# param keys read by xTrain itself, not booster params
+_XTRAIN_KEYS = ('num_estimators', 'early_stopping', 'maximize_feval', 'boosting_alg')
+
 def xTrain( d_train, param, val_data=None, prev_model=None, verbose_eval=True, boosting_alg='xgb', 
            logfile=None,  lgb_categorical_feats='auto', lgb_learning_rates=None):
     '''
@@ -282,28 +379,48 @@ def xTrain( d_train, param, val_data=None, prev_model=None, verbose_eval=True, b
         del param_xgb['feval']
         
     if boosting_alg=='xgb':
-        
-        model=xgb.train(param_xgb, d_train, num_boost_round=param_xgb['num_estimators'], 
-                 evals=watchlist,feval=feval, maximize=param_xgb['maximize_feval'], # custom metric for early stopping
+        kwargs = {}
+        if feval is not None: # custom_metric replaces feval in xgboost >= 1.6
+            kwargs['custom_metric' if 'custom_metric' in inspect.signature(xgb.train).parameters else 'feval'] = feval
+        xgb_param = dict((k, v) for k, v in param_xgb.items() if k not in _XTRAIN_KEYS)
+        model=xgb.train(xgb_param, d_train, num_boost_round=param_xgb['num_estimators'], 
+                 evals=watchlist, maximize=param_xgb.get('maximize_feval', False), # custom metric for early stopping
                  early_stopping_rounds=param_xgb['early_stopping'], 
                  evals_result=history_dict,
                  xgb_model=prev_model, # allows continuation of previously trained model
-                 verbose_eval=verbose_eval)
+                 verbose_eval=verbose_eval, **kwargs)
         
-    elif boosting_alg=='lgb':
+    elif boosting_alg=='lgb' and 'early_stopping_rounds' in inspect.signature(lgb.train).parameters: # lightgbm < 4
         model=lgb.train(param_xgb, d_train, num_boost_round=param_xgb['num_estimators'],
                        valid_sets=valid_sets, valid_names=valid_names, feval=feval,
                        init_model=prev_model, categorical_feature=lgb_categorical_feats,
                        early_stopping_rounds=param_xgb['early_stopping'],
                        evals_result=history_dict, verbose_eval=verbose_eval,
                        learning_rates=lgb_learning_rates)
+    
+    elif boosting_alg=='lgb':
+        # lightgbm >= 4: early stopping, logging, history and learning rates are callbacks
+        callbacks = [lgb.record_evaluation(history_dict)]
+        if param_xgb['early_stopping'] is not None:
+            callbacks.append(lgb.early_stopping(param_xgb['early_stopping'], verbose=bool(verbose_eval)))
+        if verbose_eval:
+            callbacks.append(lgb.log_evaluation(1 if verbose_eval is True else int(verbose_eval)))
+        if lgb_learning_rates is not None:
+            callbacks.append(lgb.reset_parameter(learning_rate=lgb_learning_rates))
+        if lgb_categorical_feats != 'auto':
+            d_train.set_categorical_feature(lgb_categorical_feats)
+        # 'early_stopping' is also an lgb alias of early_stopping_round, the callback above does that
+        lgb_param = dict((k, v) for k, v in param_xgb.items() if k not in _XTRAIN_KEYS)
+        model=lgb.train(lgb_param, d_train, num_boost_round=param_xgb['num_estimators'],
+                       valid_sets=valid_sets, valid_names=valid_names, feval=feval,
+                       init_model=prev_model, callbacks=callbacks)
     if logfile is not None:        
         sys.stdout=stdout_backup
     return model, history_dict.copy()
 
 
 def xGridSearch( d_train, params, lgb_raw_train=None, randomized=False, num_iter=None, rand_state=28081994, isCV=True, 
-              folds=5, d_holdout=None, verbose_eval=True, save_models=False, skip_param_if_same_eval=False, save_prefix='',save_folder='./model_pool', limit_complexity=None, logfile=None, boosting_alg='xgb', usealltreestopredict=False):
+              folds=5, d_holdout=None, verbose_eval=True, save_models=False, skip_param_if_same_eval=False, save_prefix='',save_folder='./model_pool', limit_complexity=None, logfile=None, boosting_alg='xgb', usealltreestopredict=False, model_format='pickle'):
     '''       
 
     Usage:
@@ -386,6 +503,9 @@ def xGridSearch( d_train, params, lgb_raw_train=None, randomized=False, num_iter
         14) skip_param_if_same_eval: This option saves the model while iterating only if the eval metric value for that parameter results in a number that has already not resulted previously (eg. some iterations over regularizations alone produce the exact same result). In case of CV folds, all 1st folds' eval is maintained, and if current matches that, remaining rounds are skipped saving time. (Also useful while ensembling a population of models for Kaggle).
         15) logfile: specify a logfile to also print to file in addition to stdout, for example, for logging status even while Jupyter screen is closed.
         16) usealltreestopredict: Specifically mention to not use the best ntree limit
+        17) model_format: 'pickle' saves model/<name>.model pickles of the whole booster; 'native' saves
+        model/<name>.native in the booster's own format truncated to the best iteration (see xExport), with the
+        param and score in <name>.native.meta.json - smaller, and xLoad + xPredict need no ntree bookkeeping.
     Note 1:
         If isCV is True does Cross Validation (Stratified) for folds times over d_train data.
         If isCV is False, then does a holdout by taking the d_holdout data.
@@ -431,7 +551,7 @@ def xGridSearch( d_train, params, lgb_raw_train=None, randomized=False, num_iter
         os.system('mkdir -p '+save_folder+'/param')
 
     if not isCV and d_holdout is None:
-        skf = StratifiedKFold(n_splits=folds, shuffle=True, random_state=rand_state)
+        skf = sk_model_selection.StratifiedKFold(n_splits=folds, shuffle=True, random_state=rand_state)
         print('Making a ', 100-100//folds, ' and ', 100//folds, ' split of Train:Test for Holdout.')
         for tr, ts in skf.split(np.zeros(len(d_train.get_label().tolist())), d_train.get_label()):
             
@@ -450,7 +570,7 @@ def xGridSearch( d_train, params, lgb_raw_train=None, randomized=False, num_iter
     if rand_state is not None:
         np.random.seed(rand_state)
 
-    pg = ParameterGrid(params)
+    pg = sk_model_selection.ParameterGrid(params)
     pglen=len(pg)
     print('Total Raw Grid Search Space to Sample: ', pglen)
     if num_iter is None:
@@ -529,7 +649,7 @@ def xGridSearch( d_train, params, lgb_raw_train=None, randomized=False, num_iter
                 val_pred = xPredict(model, d_holdout, boosting_alg,usealltreestopredict=usealltreestopredict)
                 
                 #now_best_score = model.best_score #xgb
-                #now_best_limit = model.best_ntree_limit
+                #now_best_limit = _best_ntree_limit(model)
                 
                 metric_to_use = param['eval_metric']
                 if param['feval'] is not None:
@@ -551,7 +671,7 @@ def xGridSearch( d_train, params, lgb_raw_train=None, randomized=False, num_iter
                         now_best_limit=hist['val'][metric_to_use].index(min(hist['val'][metric_to_use]))+1
                 else:
                     now_best_score = model.best_score #xgb
-                    now_best_limit = model.best_ntree_limit
+                    now_best_limit = _best_ntree_limit(model)
                 
                 
 
@@ -581,9 +701,8 @@ def xGridSearch( d_train, params, lgb_raw_train=None, randomized=False, num_iter
             if save_models:                        
                         
                 filename= save_prefix+'_holdout_'+'param'+str(counter)
-                fmodel = open(save_folder+'/model/'+filename+'.model', 'wb')
-                pickle.dump(model, fmodel)
-                fmodel.close()
+                saveModel(model, save_folder+'/model/'+filename, boosting_alg, model_format, now_best_limit,
+                          param, now_best_score, usealltreestopredict)
 
                 fhist = open(save_folder+'/history/'+filename+'.hist', 'wb')
                 pickle.dump(hist, fhist)
@@ -607,7 +726,7 @@ def xGridSearch( d_train, params, lgb_raw_train=None, randomized=False, num_iter
 
         else: # cross-validation     
 
-            skf = StratifiedKFold(n_splits=folds, shuffle=True, random_state=rand_state)
+            skf = sk_model_selection.StratifiedKFold(n_splits=folds, shuffle=True, random_state=rand_state)
             skf_split = skf.split(np.zeros(len(d_train.get_label().tolist())), d_train.get_label())
             foldcounter=0
             for tr, ts in skf_split:
@@ -650,7 +769,7 @@ def xGridSearch( d_train, params, lgb_raw_train=None, randomized=False, num_iter
                             now_best_limit=hist['val'][metric_to_use].index(min(hist['val'][metric_to_use]))+1
                     else:
                         now_best_score = model.best_score #xgb
-                        now_best_limit = model.best_ntree_limit
+                        now_best_limit = _best_ntree_limit(model)
                 elif boosting_alg=='lgb':
                    
                     metric_to_use = param['metric']
@@ -678,9 +797,8 @@ def xGridSearch( d_train, params, lgb_raw_train=None, randomized=False, num_iter
                 
                 if save_models:
                     filename=save_prefix+'_cv_'+'param'+str(counter)+'_fold'+str(foldcounter)
-                    fmodel = open(save_folder+'/model/'+filename+'.model', 'wb')
-                    pickle.dump(model, fmodel)
-                    fmodel.close()
+                    saveModel(model, save_folder+'/model/'+filename, boosting_alg, model_format, now_best_limit,
+                              param, now_best_score, usealltreestopredict)
                     
                     fhist = open(save_folder+'/history/'+filename+'.hist', 'wb')
                     pickle.dump(hist, fhist)
@@ -846,4 +964,21 @@ def getModelPoolStats(modelpool_dirs=['./model_pool'], metric=['auc','gini','bin
     df = pd.DataFrame(records)
     df.columns = columns
     
-    return df          
\ No newline at end of file
+    return df          
+
+def getModelPoolPreds(modelpool_dir='./model_pool', save_prefix='', pred_column=-1):
+    '''
+    Collects the out-of-fold validation predictions saved by xGridSearch (save_models=True, isCV=True) from
+    modelpool_dir/valpred/<save_prefix>_cv_param<N>.validation into one DataFrame, one column per
+    param (named like the file), rows in the order of d_train. Ready for caruanaFitter.
+    
+    pred_column: which prediction column to keep when the model outputs several (default: last, ie. class 1
+    for binary multi:softprob).
+    '''
+    cols = {}
+    for f in sorted(os.listdir(modelpool_dir+'/valpred/')):
+        if not f.endswith('.validation') or not f.startswith(save_prefix+'_cv_'):
+            continue
+        valpreddf = pd.read_csv(modelpool_dir+'/valpred/'+f, index_col=0)
+        cols[f.split('.validation')[0]] = valpreddf.iloc[:, pred_column].values
+    return pd.DataFrame(cols)